@@ -1,192 +1,133 @@
-from PIL import Image, ImageFont, ImageDraw, ImageFile
-from collections import defaultdict
-import os
-import glob
-import json
+import argparse
 import sys
 
-from ctg_builder import settings, utils
-from ctg_builder.models import ParkImage
-
 if sys.version_info[0] != 3:
     print("This script requires Python version 3.0 or later")
     sys.exit(1)
 
-ImageFile.LOAD_TRUNCATED_IMAGES = True
-
-
-def add_watermark_to_image(
-        img, watermark_text, watermark_rgb, watermark_font_size):
-    watermark_location = (watermark_font_size,
-                          img.height - watermark_font_size * 2)
-    draw = ImageDraw.Draw(img)
-    font = ImageFont.truetype("fonts/arial.ttf", watermark_font_size)
-    draw.text(watermark_location, watermark_text, watermark_rgb, font=font)
-
-    return img
-
-
-def get_park_image_models(src_filepaths, src_dirpath, dest_dirpath, img_output_instances):
-    park_images = []
-
-    for src_filepath in src_filepaths:
-        park_image = ParkImage(
-            src_filepath=src_filepath,
-            src_dirpath=src_dirpath,
-            dest_dirpath=dest_dirpath,
-            img_output_instances=img_output_instances
-        )
-        park_images.append(park_image)
-
-    return park_images
-
-
-def process_and_save_images(park_image_models, src_master_dirpath, img_settings):
-    for park_image_model in park_image_models:
-        dest_instances = park_image_model.dest_instances
-        src_filepath = park_image_model.src_filepath
-
-        for dest_instance in dest_instances:
-            dest_filepath = dest_instance.filepath
-
-            dest_dirpath = os.path.dirname(dest_filepath)
-
-            # Create result directory if it doesn't exist
-            if not os.path.exists(dest_dirpath):
-                os.makedirs(dest_dirpath)
-
-            # Skip if dest_filepath already exists
-            if os.path.isfile(dest_filepath):
-                continue
-
-            rel_src_filepath = os.path.relpath(src_filepath, src_master_dirpath)
-            print()
-            print('Converting ' + rel_src_filepath + '...')
-
-            img = Image.open(src_filepath)
 
-            # Process and save image instance (resize, apply enhancements, add watermark, etc.)
-            instance_settings = img_settings.output_instances[
-                dest_instance.img_name]
-            output_image_width = instance_settings.img_width
-            output_image_height = instance_settings.img_height
-            watermark_font_size = instance_settings.watermark_font_size
-
-            result_img = img
-
-            result_img = utils.resize_fill_image(
-                result_img, output_image_width, output_image_height, Image.BICUBIC)
-
-            result_img = utils.canvas_resize_image(
-                result_img, output_image_width, output_image_height)
-
-            result_img = instance_settings.enhancement_algorithm_list.enhance(result_img)
-
-            result_img = add_watermark_to_image(
-                result_img, img_settings.Watermark.text,
-                img_settings.Watermark.rgb, watermark_font_size)
-
-            result_img.save(dest_filepath, "JPEG", quality=img_settings.jpeg_quality, optimize=True, progressive=True)
-
-
-def remove_extra_files_if_confirmed(dir_path, expected_filepaths):
-    expected_filepaths_set = set(
-        [os.path.abspath(filepath) for filepath in expected_filepaths])
-
-    extra_filepaths = []
-
-    actual_filepaths = glob.glob(os.path.join(dir_path, "*.*"))
-    for actual_filepath in actual_filepaths:
-        abs_actual_filepath = os.path.abspath(actual_filepath)
-        if abs_actual_filepath in expected_filepaths_set:
-            continue
-        if not os.path.isfile(abs_actual_filepath):
-            continue
-        extra_filepaths.append(abs_actual_filepath)
+def confirm_remove_extra_files(extra_filepaths):
+    user_input = input('If you wish to remove them, type ''delete'': ')
+    print('You entered ' + user_input)
+    return user_input == 'delete'
+
+
+def parse_shard(value):
+    try:
+        shard_index, shard_count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected INDEX/COUNT, e.g. 0/4')
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise argparse.ArgumentTypeError(
+            'shard index must be between 0 and COUNT - 1')
+    return shard_index, shard_count
+
+
+def parse_args():
+    from ctg_builder.sharding import SHARD_BY_PARK, SHARD_KEYS
+
+    parser = argparse.ArgumentParser(
+        description='Build trail guide images and park content.')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of processes used to render images (default: 1)')
+    parser.add_argument(
+        '--profile', metavar='REPORT_PATH',
+        help='time every render stage and write the results to REPORT_PATH '
+             '(CSV stage summary if it ends in .csv, full JSON report otherwise)')
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help='overlap source reads and output writes with rendering')
+    parser.add_argument(
+        '--memory-budget', type=int, default=512, metavar='MB',
+        help='with --pipeline, the most source and output data to hold in '
+             'memory at once (default: 512)')
+    parser.add_argument(
+        '--shard', type=parse_shard, metavar='INDEX/COUNT',
+        help='only render shard INDEX of COUNT and write a partial result '
+             'instead of the park content JS')
+    parser.add_argument(
+        '--shard-by', choices=SHARD_KEYS, default=SHARD_BY_PARK,
+        help='with --shard, partition sources by park or by source directory '
+             'hash (default: park)')
+    parser.add_argument(
+        '--partial', metavar='PARTIAL_PATH',
+        help='with --shard, where to write the partial result (default: '
+             '.partial.shard-INDEX-of-COUNT.json in the destination directory)')
+    parser.add_argument(
+        '--merge', nargs='+', metavar='PARTIAL_PATH',
+        help='skip rendering and write the park content JS from the partial '
+             'results of every shard')
+    parser.add_argument(
+        '--content-modules', metavar='DIR',
+        help='instead of the park content JS, write a compact index module '
+             'and one module per place to DIR, rewriting only changed ones')
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='keep running and rebuild whenever sources or the park content '
+             'JSON change')
+    parser.add_argument(
+        '--poll-interval', type=float, default=2.0, metavar='SECONDS',
+        help='with --watch, how often to check for changes (default: 2)')
+    parser.add_argument(
+        '--order', choices=('discovery', 'largest-first'),
+        help='order in which to render sources: as discovered, or costliest '
+             'first by pixel count and file size, which plans and hashes every '
+             'source before the first render (default: largest-first with more '
+             'than one worker once source hashes are cached, discovery otherwise)')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='only plan the build and report how many images would be '
+             'rendered, without decoding images or saving anything')
+    args = parser.parse_args()
+    if args.watch and (args.shard or args.merge):
+        parser.error('--watch cannot be combined with --shard or --merge')
+    if args.dry_run and (args.watch or args.merge):
+        parser.error('--dry-run cannot be combined with --watch or --merge')
+    return args
+
+
+def main():
+    args = parse_args()
+
+    # Imported here so this script can be imported without a settings module
+    from ctg_builder import settings
+    from ctg_builder.build import BuildConfig, build, check_encoder_profiles, merge, watch
+    from ctg_builder.sharding import Shard
+
+    config = BuildConfig(
+        settings,
+        worker_count=args.workers,
+        profile_filepath=args.profile,
+        memory_budget_bytes=args.memory_budget * 1024 * 1024 if args.pipeline else None,
+        shard=Shard(args.shard[0], args.shard[1], args.shard_by) if args.shard else None,
+        partial_filepath=args.partial,
+        content_modules_dirpath=args.content_modules,
+        poll_interval=args.poll_interval,
+        confirm_remove=confirm_remove_extra_files,
+        dry_run=args.dry_run,
+        largest_first=args.order == 'largest-first' if args.order else None)
+
+    try:
+        check_encoder_profiles(config)
+    except ValueError as e:
+        print(str(e))
+        sys.exit(1)
+
+    if args.merge:
+        try:
+            merge(config, args.merge)
+        except (OSError, ValueError) as e:
+            print('Could not merge partial build results: ' + str(e))
+            sys.exit(1)
+        return
 
-    if len(extra_filepaths) == 0:
+    if args.watch:
+        watch(config)
         return
 
-    print('The following extra images exist at the destination: ')
-    for extra_filepath in extra_filepaths:
-        print(extra_filepath)
+    build(config)
 
-    user_input = input('If you wish to remove them, type ''delete'': ')
-    print('You entered ' + user_input)
 
-    if user_input == 'delete':
-        print('Removing extra files...')
-        extra_filepaths_set = set(extra_filepaths)
-        for extra_filepath in extra_filepaths_set:
-            os.remove(extra_filepath)
-
-
-def save_park_images_to_park_content(park_image_models, park_content):
-    park_images_by_park = defaultdict(list)
-    for park_image_model in park_image_models:
-        park_name = park_image_model.park_name
-        park_images_by_park[park_name].append(park_image_model)
-
-    places = park_content['places']
-    for place in places:
-        park_name = place['name']
-        if park_name not in park_images_by_park:
-            print(park_name + ' not found in park content JSON file')
-            continue
-
-        images_for_park = park_images_by_park[park_name]
-        print(place['name'] + ' has ' + str(len(images_for_park)) + ' images')
-
-        place['images'] = defaultdict(list)
-        place_images = place['images']
-        for park_image_model in images_for_park:
-            for dest_instance in park_image_model.dest_instances:
-                instance_name = dest_instance.img_name
-                filename = os.path.basename(dest_instance.filepath)
-                image_path = os.path.join(settings.DirPaths.site_image_dir, filename)
-                place_images[instance_name].append({
-                    "path": image_path,
-                    "date": park_image_model.date_photo_taken
-                })
-
-
-print("Getting list of source image paths...")
-src_filepaths = utils.get_full_filepaths_in_tree(settings.DirPaths.src_images)
-
-print("Building path transformations from "
-      "source image path to destination image paths...")
-
-park_image_models = get_park_image_models(
-    src_filepaths=src_filepaths,
-    src_dirpath=settings.DirPaths.src_images,
-    dest_dirpath=settings.DirPaths.dest_images,
-    img_output_instances=settings.ImageProcessing.output_instances)
-
-
-print("Processing and saving images to respective output paths...")
-process_and_save_images(
-    park_image_models,
-    src_master_dirpath=settings.DirPaths.src_images,
-    img_settings=settings.ImageProcessing)
-
-# Get destination filepaths from park_image_models
-dest_filepaths = []
-for park_image_model in park_image_models:
-    dest_filepaths.extend(park_image_model.get_dest_image_paths())
-
-print('Test: ' + dest_filepaths[0])
-remove_extra_files_if_confirmed(settings.DirPaths.dest_images, dest_filepaths)
-
-print('Loading park content JSON...')
-park_content = {}
-with open(settings.FilePaths.src_park_content_json) as src_park_content_file:
-    park_content = json.load(src_park_content_file)
-
-print('Adding park image paths to park content...')
-save_park_images_to_park_content(park_image_models, park_content)
-
-print('Saving park content JSON to destination JS...')
-park_content_json = json.dumps(park_content, indent=1, cls=utils.DateTimeEncoder)
-park_content_js = 'module.exports = ' + park_content_json + ';'
-with open(settings.FilePaths.dest_park_content_js, 'w') as dest_park_content_file:
-    dest_park_content_file.write(park_content_js)
+if __name__ == '__main__':
+    main()
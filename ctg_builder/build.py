@@ -0,0 +1,769 @@
+"""Build API: discover, plan, render, prune and publish park images.
+
+build(config) runs every stage, and each stage can also be called on its
+own with a BuildConfig and the BuildState returned by open_build_state.
+Discovery, planning and rendering are generators, so sources stream from
+one stage into the next without the whole tree being held in memory.
+The renderer, the worker pool and the pipelined renderer are only imported
+when images are actually rendered, so planning does not load the PIL
+modules that only rendering uses.
+"""
+from collections import defaultdict, deque
+import copy
+import functools
+import glob
+import itertools
+import json
+import os
+import time
+
+from ctg_builder import utils
+from ctg_builder.catalog import ParkImageCatalog
+from ctg_builder.content_modules import ContentModuleWriter
+from ctg_builder.duplicates import DuplicateIndex
+from ctg_builder.encoding import get_encoder_profiles
+from ctg_builder.metadata_index import MetadataIndex, METADATA_INDEX_FILENAME
+from ctg_builder.manifest import BuildManifest, MANIFEST_FILENAME, get_settings_fingerprint
+from ctg_builder.models import ParkImage, RenderJob
+from ctg_builder.profiling import BuildProfiler
+from ctg_builder.scheduling import order_largest_first
+from ctg_builder.sharding import SHARD_BY_PARK, merge_partials
+from ctg_builder.watching import SourceTreeWatcher
+
+
+class BuildConfig:
+    """Settings and options of a build.
+
+    settings is an object with the DirPaths, FilePaths and ImageProcessing
+    classes of a settings module. confirm_remove is called with the paths of
+    extra files at the destination and returns whether to delete them; they
+    are only listed if it is not given.
+    """
+
+    def __init__(self, settings, worker_count=1, profile_filepath=None, memory_budget_bytes=None,
+                 shard=None, partial_filepath=None, content_modules_dirpath=None,
+                 poll_interval=2.0, confirm_remove=None, dry_run=False, largest_first=None):
+        self.settings = settings
+        self.worker_count = worker_count
+        self.profile_filepath = profile_filepath
+        # Render as an overlapped pipeline within this budget if given
+        self.memory_budget_bytes = memory_budget_bytes
+        self.shard = shard
+        self.partial_filepath = partial_filepath
+        self.content_modules_dirpath = content_modules_dirpath
+        self.poll_interval = poll_interval
+        self.confirm_remove = confirm_remove
+        self.dry_run = dry_run
+        # Render the costliest jobs first, or if None, decide when rendering
+        self.largest_first = largest_first
+
+    @property
+    def duplicate_distance(self):
+        return getattr(self.settings.ImageProcessing, 'duplicate_distance', None)
+
+
+class BuildState:
+    """Persistent indices and collected results shared by the stages of a
+    build.
+    """
+
+    def __init__(self, metadata_index, manifest, catalog, settings_fingerprints,
+                 duplicate_index=None, profiler=None):
+        self.metadata_index = metadata_index
+        self.manifest = manifest
+        self.catalog = catalog
+        # One fingerprint per encoder profile of each output instance
+        self.settings_fingerprints = settings_fingerprints
+        self.duplicate_index = duplicate_index
+        self.profiler = profiler
+        self.planned_job_count = 0
+        self.planned_instance_count = 0
+        # Sources that failed to render and have no previous outputs to
+        # publish instead
+        self.failed_src_filepaths = set()
+
+
+def check_encoder_profiles(config):
+    """Raise ValueError if an output instance uses a format that this Pillow
+    build cannot encode, or the same format twice.
+    """
+    for img_name, instance_settings in config.settings.ImageProcessing.output_instances.items():
+        formats = set()
+        for encoder_profile in get_encoder_profiles(instance_settings):
+            if not encoder_profile.is_supported():
+                raise ValueError(
+                    'Output instance ' + img_name + ' uses the ' + encoder_profile.format +
+                    ' format, which this Pillow build cannot encode')
+            # Both profiles would be saved to the same file
+            if encoder_profile.format in formats:
+                raise ValueError(
+                    'Output instance ' + img_name + ' has more than one ' +
+                    encoder_profile.format + ' encoder profile')
+            formats.add(encoder_profile.format)
+
+
+def open_build_state(config):
+    settings = config.settings
+    dest_dirpath = settings.DirPaths.dest_images
+    img_settings = settings.ImageProcessing
+
+    # Shards share the destination directory, so each keeps its own state
+    # files and only prunes its own sources
+    metadata_index_filename = METADATA_INDEX_FILENAME
+    manifest_filename = MANIFEST_FILENAME
+    if config.shard:
+        metadata_index_filename = config.shard.get_filename(metadata_index_filename)
+        manifest_filename = config.shard.get_filename(manifest_filename)
+
+    settings_fingerprints = {}
+    for img_name, instance_settings in img_settings.output_instances.items():
+        settings_fingerprints[img_name] = [
+            get_settings_fingerprint(instance_settings, img_settings, encoder_profile)
+            for encoder_profile in get_encoder_profiles(instance_settings)]
+
+    # Hashing for near-duplicates decodes every new source, so dry runs
+    # treat every source as unique
+    duplicate_index = None
+    if config.duplicate_distance is not None and not config.dry_run:
+        duplicate_index = DuplicateIndex(config.duplicate_distance)
+
+    return BuildState(
+        metadata_index=MetadataIndex(
+            os.path.join(dest_dirpath, metadata_index_filename), journaled=not config.dry_run),
+        manifest=BuildManifest(os.path.join(dest_dirpath, manifest_filename)),
+        catalog=ParkImageCatalog(dest_dirpath, img_settings.output_instances),
+        settings_fingerprints=settings_fingerprints,
+        duplicate_index=duplicate_index,
+        profiler=BuildProfiler() if config.profile_filepath else None)
+
+
+def iter_park_image_models(src_filepaths, src_dirpath, dest_dirpath, img_output_instances, metadata_index=None, perceptual_hashing=False, max_source_pixels=None):
+    """Yield a ParkImage for each source as soon as it is built, so
+    rendering can start before the whole tree has been scanned.
+    """
+    for src_filepath in src_filepaths:
+        # Skip unreadable sources rather than aborting the whole run
+        try:
+            park_image = ParkImage(
+                src_filepath=src_filepath,
+                src_dirpath=src_dirpath,
+                dest_dirpath=dest_dirpath,
+                img_output_instances=img_output_instances,
+                metadata_index=metadata_index,
+                perceptual_hashing=perceptual_hashing,
+                max_source_pixels=max_source_pixels
+            )
+        except Exception as e:
+            print('Skipping ' + src_filepath + ': ' + type(e).__name__ + ': ' + str(e))
+            continue
+        yield park_image
+
+
+def iter_unique_park_image_models(park_image_models, duplicate_index, src_dirpath):
+    """Yield only the park images that are not near-duplicates of one
+    yielded before them in the same park.
+    """
+    for park_image_model in park_image_models:
+        duplicate = duplicate_index.find_or_add(park_image_model)
+        if duplicate:
+            distance, representative_filepath = duplicate
+            print('Skipping ' + os.path.relpath(park_image_model.src_filepath, src_dirpath) +
+                  ', near-duplicate of ' + os.path.relpath(representative_filepath, src_dirpath) +
+                  ' (distance ' + str(distance) + ')')
+            continue
+        yield park_image_model
+
+
+def discover(config, state):
+    """Yield the park image of every source to build, adding each one to
+    the catalog of state.
+    """
+    settings = config.settings
+    src_filepaths = utils.iter_image_filepaths_in_tree(settings.DirPaths.src_images)
+
+    if config.shard:
+        print('Building ' + config.shard.name + ' by ' + config.shard.shard_by)
+        src_filepaths = config.shard.select(src_filepaths, settings.DirPaths.src_images)
+        if config.shard.shard_by != SHARD_BY_PARK and config.duplicate_distance is not None:
+            print('Warning: near-duplicates are only grouped within a shard when '
+                  'sharding by ' + config.shard.shard_by)
+
+    park_image_models = iter_park_image_models(
+        src_filepaths=src_filepaths,
+        src_dirpath=settings.DirPaths.src_images,
+        dest_dirpath=settings.DirPaths.dest_images,
+        img_output_instances=settings.ImageProcessing.output_instances,
+        metadata_index=state.metadata_index,
+        perceptual_hashing=state.duplicate_index is not None,
+        max_source_pixels=getattr(settings.ImageProcessing, 'max_source_pixels', None))
+
+    # Only render and publish one image of each group of near-duplicates
+    if state.duplicate_index:
+        park_image_models = iter_unique_park_image_models(
+            park_image_models, state.duplicate_index, settings.DirPaths.src_images)
+
+    return utils.iter_and_collect(park_image_models, state.catalog)
+
+
+def plan(config, state, park_image_models):
+    """Yield a render job for every park image with outputs that are missing
+    or were built from different source bytes or settings.
+
+    In a dry run, sources whose size or mtime changed are assumed to be
+    stale rather than hashed, so planning never reads image data.
+    """
+    manifest = state.manifest
+    for park_image_model in park_image_models:
+        try:
+            source_key = manifest.get_source_key(
+                park_image_model.src_filepath, rehash=not config.dry_run)
+        except OSError as e:
+            print('Skipping ' + park_image_model.src_filepath + ': ' + str(e))
+            continue
+
+        pending_instances = []
+        for dest_instance in park_image_model.dest_instances:
+            # All formats of an instance are encoded together, so rebuild them
+            # all if any one is stale
+            if all(manifest.is_up_to_date(dest_filepath, source_key, settings_fingerprint)
+                   for dest_filepath, settings_fingerprint in zip(
+                       dest_instance.filepaths,
+                       state.settings_fingerprints[dest_instance.img_name])):
+                manifest.reused_count += 1
+            else:
+                pending_instances.append(dest_instance)
+
+        if pending_instances:
+            state.planned_job_count += 1
+            state.planned_instance_count += len(pending_instances)
+            yield RenderJob(park_image_model, pending_instances, source_key)
+
+
+def imap_bounded(pool, func, iterable, max_pending):
+    """Like Pool.imap, but only pulls from iterable while fewer than
+    max_pending results are outstanding, so a lazy iterable is not drained
+    into the task queue up front.
+    """
+    pending_results = deque()
+    for item in iterable:
+        pending_results.append(pool.apply_async(func, (item,)))
+        if len(pending_results) >= max_pending:
+            yield pending_results.popleft().get()
+
+    while pending_results:
+        yield pending_results.popleft().get()
+
+
+def render(config, state, render_jobs):
+    """Render every job in render_jobs and record the outputs in the
+    manifest.
+
+    If config.memory_budget_bytes is given, reading, rendering and writing
+    run as overlapped pipeline stages that hold at most that many source
+    and output bytes in memory. If config.largest_first is set, every job is
+    planned before the costliest ones are dispatched first.
+
+    By default only parallel runs are reordered, where the last jobs decide
+    how long the other workers sit idle, and only once the manifest has
+    source hashes: planning every job up front hashes every uncached source
+    before the first render starts.
+    """
+    settings = config.settings
+    img_settings = settings.ImageProcessing
+    worker_count = config.worker_count
+    memory_budget_bytes = config.memory_budget_bytes
+    manifest = state.manifest
+    report = functools.partial(
+        report_render_results, src_master_dirpath=settings.DirPaths.src_images,
+        manifest=manifest, settings_fingerprints=state.settings_fingerprints,
+        failed_src_filepaths=state.failed_src_filepaths, profiler=state.profiler)
+
+    # Imported here so planning alone does not pay for them
+    from multiprocessing import Pool
+    from ctg_builder.pipelining import render_pipelined
+    from ctg_builder.rendering import render_park_image
+
+    render_job = functools.partial(render_park_image, img_settings=img_settings)
+
+    largest_first = config.largest_first
+    if largest_first is None:
+        largest_first = worker_count > 1 and bool(manifest.sources)
+    if largest_first:
+        render_jobs = order_largest_first(render_jobs)
+        print('Rendering ' + str(len(render_jobs)) + ' sources largest first')
+
+    try:
+        if memory_budget_bytes and worker_count > 1:
+            with Pool(worker_count) as pool:
+                report(render_pipelined(
+                    render_jobs, img_settings, memory_budget_bytes,
+                    pool=pool, worker_count=worker_count))
+        elif memory_budget_bytes:
+            report(render_pipelined(render_jobs, img_settings, memory_budget_bytes))
+        elif worker_count > 1:
+            with Pool(worker_count) as pool:
+                report(imap_bounded(
+                    pool, render_job, render_jobs, max_pending=worker_count * 2))
+        else:
+            report(map(render_job, render_jobs))
+    finally:
+        # Keep what was rendered so far even if the run is interrupted
+        manifest.save()
+
+    print(str(manifest.reused_count) + ' images reused, ' +
+          str(manifest.rebuilt_count) + ' images rebuilt')
+
+
+def report_render_results(results, src_master_dirpath, manifest, settings_fingerprints, failed_src_filepaths=None, profiler=None):
+    """Record and report the outputs of each render result.
+
+    Sources that failed are added to failed_src_filepaths, unless every
+    output that was not rendered is left over from an earlier build, in which
+    case those previous outputs are kept and published.
+    """
+    # Imported here like the renderer, see render
+    from ctg_builder.image_algorithm import PROXY_FACTOR_TOLERANCE
+    from ctg_builder.rendering import SourceTooLargeError
+
+    failed_count = 0
+    bounded_count = 0
+    too_large_count = 0
+    allocated_bytes = 0
+    proxy_factor_errors = []
+    cascade_psnrs_by_instance = defaultdict(list)
+    encoded_bytes_by_format = defaultdict(int)
+    encode_seconds_by_format = defaultdict(float)
+
+    for result in results:
+        rel_src_filepath = os.path.relpath(result.src_filepath, src_master_dirpath)
+        source_key = result.render_job.source_key
+        allocated_bytes += result.allocated_bytes
+        proxy_factor_errors.extend(result.proxy_factor_errors)
+        for img_name, psnr in result.cascade_psnrs:
+            cascade_psnrs_by_instance[img_name].append(psnr)
+        for format_name, byte_count in result.profile.encoded_bytes_by_format.items():
+            encoded_bytes_by_format[format_name] += byte_count
+        for stage_name, _, duration in result.profile.stage_timings:
+            if stage_name.startswith('encode-'):
+                encode_seconds_by_format[stage_name[len('encode-'):]] += duration
+        if profiler:
+            profiler.add(result.src_filepath, result.profile)
+
+        for dest_instance in result.rendered_instances:
+            print()
+            print('Converting ' + rel_src_filepath + '...')
+            for dest_filepath, settings_fingerprint in zip(
+                    dest_instance.filepaths,
+                    settings_fingerprints[dest_instance.img_name]):
+                manifest.record(dest_filepath, source_key, settings_fingerprint)
+            manifest.rebuilt_count += 1
+
+        if result.bounded_decode:
+            bounded_count += 1
+            print('Decoded ' + rel_src_filepath + ' within the source pixel budget (' +
+                  result.bounded_decode + ')')
+
+        if result.error:
+            failed_count += 1
+            if result.error.startswith(SourceTooLargeError.__name__ + ':'):
+                too_large_count += 1
+            print()
+            print('Error converting ' + rel_src_filepath + ': ' + result.error)
+
+            rendered_img_names = set(
+                dest_instance.img_name for dest_instance in result.rendered_instances)
+            if all(os.path.isfile(dest_filepath)
+                   for dest_instance in result.render_job.dest_instances
+                   if dest_instance.img_name not in rendered_img_names
+                   for dest_filepath in dest_instance.filepaths):
+                print('Keeping the previous images of ' + rel_src_filepath)
+            elif failed_src_filepaths is not None:
+                failed_src_filepaths.add(result.src_filepath)
+
+        for proxy_factor_error in result.proxy_factor_errors:
+            if proxy_factor_error > PROXY_FACTOR_TOLERANCE:
+                print('Proxy enhancement factors for ' + rel_src_filepath +
+                      ' are off by ' + str(round(proxy_factor_error * 100, 2)) + '%')
+
+    if failed_count > 0:
+        print(str(failed_count) + ' images could not be converted')
+    if failed_src_filepaths:
+        print(str(len(failed_src_filepaths)) + ' images without previous outputs '
+              'are left out of the park content')
+
+    if too_large_count > 0:
+        print(str(too_large_count) + ' images were over the source pixel budget in a format '
+              'that cannot be decoded at reduced size (only JPEG and uncompressed '
+              'TIFF, BMP, PPM and TGA can be)')
+
+    if bounded_count > 0:
+        print(str(bounded_count) + ' images were over the source pixel budget '
+              'and decoded at reduced size')
+
+    if proxy_factor_errors:
+        print('Proxy enhancement factors were within ' +
+              str(round(max(proxy_factor_errors) * 100, 2)) + '% of full resolution (' +
+              str(sum(1 for e in proxy_factor_errors if e > PROXY_FACTOR_TOLERANCE)) +
+              ' of ' + str(len(proxy_factor_errors)) + ' over the ' +
+              str(PROXY_FACTOR_TOLERANCE * 100) + '% tolerance)')
+
+    for img_name, psnrs in sorted(cascade_psnrs_by_instance.items()):
+        finite_psnrs = [psnr for psnr in psnrs if psnr != float('inf')]
+        if not finite_psnrs:
+            print('Cascade ' + img_name + ' images match the independent path')
+            continue
+        print('Cascade ' + img_name + ' images differ from the independent path by ' +
+              str(round(min(finite_psnrs), 1)) + ' dB PSNR at worst, ' +
+              str(round(utils.mean(finite_psnrs), 1)) + ' dB on average')
+
+    for format_name, byte_count in sorted(encoded_bytes_by_format.items()):
+        print('Encoded ' + str(round(byte_count / (1024 * 1024), 1)) + ' MB of ' +
+              format_name + ' in ' +
+              str(round(encode_seconds_by_format[format_name], 1)) + ' s')
+
+    print('Resizing allocated ' +
+          str(round(allocated_bytes / (1024 * 1024), 1)) + ' MB')
+
+
+def prune(config, state):
+    """Save the indices of state without the sources and outputs that are no
+    longer part of the build, and remove extra files at the destination.
+    """
+    catalog = state.catalog
+    metadata_index = state.metadata_index
+
+    # Neither publish failed sources nor keep their outputs and manifest
+    # entries, so they are rendered again on the next run
+    if state.failed_src_filepaths:
+        catalog.remove(state.failed_src_filepaths)
+
+    print('Read metadata for ' + str(metadata_index.miss_count) + ' images, ' +
+          str(metadata_index.hit_count) + ' loaded from index')
+    if state.duplicate_index:
+        print(str(len(state.duplicate_index.duplicate_filepaths)) +
+              ' near-duplicate images skipped')
+
+    # Keep the hashes of skipped near-duplicates and the metadata of failed
+    # sources for the next run
+    metadata_index.prune(itertools.chain(
+        catalog.iter_src_filepaths(),
+        state.duplicate_index.duplicate_filepaths if state.duplicate_index else [],
+        state.failed_src_filepaths))
+    metadata_index.save()
+
+    if state.profiler:
+        print('Saving profile report to ' + config.profile_filepath + '...')
+        state.profiler.save(config.profile_filepath)
+
+    # Forget sources and outputs that are no longer part of the build
+    state.manifest.prune(catalog.iter_src_filepaths(), catalog.iter_dest_filepaths())
+    state.manifest.save()
+
+    # Other shards' outputs look extra to a shard, so that is left to the
+    # merge step
+    if not config.shard:
+        remove_extra_files(config, catalog)
+
+
+def get_extra_filepaths(dir_path, catalog):
+    extra_filepaths = []
+
+    actual_filepaths = glob.glob(os.path.join(dir_path, "*.*"))
+    for actual_filepath in actual_filepaths:
+        abs_actual_filepath = os.path.abspath(actual_filepath)
+        if catalog.contains_dest_filename(os.path.basename(abs_actual_filepath)):
+            continue
+        if not os.path.isfile(abs_actual_filepath):
+            continue
+        extra_filepaths.append(abs_actual_filepath)
+
+    return extra_filepaths
+
+
+def remove_extra_files(config, catalog):
+    extra_filepaths = get_extra_filepaths(config.settings.DirPaths.dest_images, catalog)
+    if len(extra_filepaths) == 0:
+        return
+
+    print('The following extra images exist at the destination: ')
+    for extra_filepath in extra_filepaths:
+        print(extra_filepath)
+
+    if config.confirm_remove and config.confirm_remove(extra_filepaths):
+        print('Removing extra files...')
+        extra_filepaths_set = set(extra_filepaths)
+        for extra_filepath in extra_filepaths_set:
+            os.remove(extra_filepath)
+
+
+def save_park_images_to_park_content(catalog, park_content, settings):
+    indices_by_park = catalog.get_indices_by_park()
+
+    places = park_content['places']
+    for place in places:
+        park_name = place['name']
+        if park_name not in indices_by_park:
+            print(park_name + ' not found in park content JSON file')
+            continue
+
+        indices_for_park = indices_by_park[park_name]
+        print(place['name'] + ' has ' + str(len(indices_for_park)) + ' images')
+
+        place['images'] = defaultdict(list)
+        place_images = place['images']
+        for i in indices_for_park:
+            date_photo_taken = catalog.get_date_photo_taken(i)
+            for instance_name, filenames in catalog.get_dest_filenames(i):
+                image = {
+                    "path": os.path.join(settings.DirPaths.site_image_dir, filenames[0]),
+                    "date": date_photo_taken
+                }
+                # List every format only for instances encoded more than once,
+                # keeping the path of the primary format for older clients
+                if len(filenames) > 1:
+                    image["formats"] = {
+                        encoder_profile.name: os.path.join(settings.DirPaths.site_image_dir, filename)
+                        for encoder_profile, filename in zip(
+                            get_encoder_profiles(
+                                settings.ImageProcessing.output_instances[instance_name]),
+                            filenames)}
+                place_images[instance_name].append(image)
+
+
+def get_park_content_js(catalog, park_content, settings):
+    save_park_images_to_park_content(catalog, park_content, settings)
+    park_content_json = json.dumps(park_content, indent=1, cls=utils.DateTimeEncoder)
+    return 'module.exports = ' + park_content_json + ';'
+
+
+def save_park_content_modules(catalog, park_content, settings, content_module_writer):
+    save_park_images_to_park_content(catalog, park_content, settings)
+    content_module_writer.write(park_content)
+    print('Wrote ' + str(content_module_writer.written_count) + ' park content modules, ' +
+          str(content_module_writer.unchanged_count) + ' unchanged')
+    content_module_writer.written_count = 0
+    content_module_writer.unchanged_count = 0
+
+
+def publish(config, catalog):
+    """Write the park content with the images of catalog, or for a shard,
+    the partial result the merge step publishes from.
+    """
+    settings = config.settings
+
+    if config.shard:
+        partial_filepath = config.partial_filepath or os.path.join(
+            settings.DirPaths.dest_images, config.shard.get_filename('.partial.json'))
+        print('Saving partial result to ' + partial_filepath + '...')
+        config.shard.save_partial(partial_filepath, catalog)
+        return
+
+    print('Loading park content JSON...')
+    park_content = {}
+    with open(settings.FilePaths.src_park_content_json) as src_park_content_file:
+        park_content = json.load(src_park_content_file)
+
+    if config.content_modules_dirpath:
+        print('Saving park content modules to ' + config.content_modules_dirpath + '...')
+        save_park_content_modules(
+            catalog, park_content, settings,
+            ContentModuleWriter(config.content_modules_dirpath))
+        return
+
+    print('Adding park image paths to park content...')
+    park_content_js = get_park_content_js(catalog, park_content, settings)
+
+    print('Saving park content JSON to destination JS...')
+    with open(settings.FilePaths.dest_park_content_js, 'w') as dest_park_content_file:
+        dest_park_content_file.write(park_content_js)
+
+
+def report_plan(config, state):
+    """Plan the build without rendering or saving anything, and print how
+    much work it would do.
+    """
+    print('Planning build without rendering...')
+    if config.duplicate_distance is not None:
+        print('Near-duplicates are not looked for in a dry run')
+
+    start_time = time.perf_counter()
+    for _ in plan(config, state, discover(config, state)):
+        pass
+
+    print(str(len(state.catalog)) + ' sources, ' +
+          str(state.manifest.reused_count) + ' images up to date, ' +
+          str(state.planned_instance_count) + ' images of ' +
+          str(state.planned_job_count) + ' sources to render (planned in ' +
+          str(round(time.perf_counter() - start_time, 1)) + ' s)')
+
+
+def build(config):
+    """Run every stage of a build, or only plan it if config.dry_run is set,
+    and get its BuildState.
+    """
+    check_encoder_profiles(config)
+
+    # State files are saved even when no image is rendered, e.g. for a shard
+    # with no sources
+    os.makedirs(config.settings.DirPaths.dest_images, exist_ok=True)
+    state = open_build_state(config)
+    if state.manifest.replayed_count:
+        print('Resuming from checkpoint journal, ' +
+              str(state.manifest.replayed_count) + ' images already rendered')
+
+    if config.dry_run:
+        report_plan(config, state)
+        return state
+
+    print("Discovering source images and rendering them to respective output paths...")
+    render(config, state, plan(config, state, discover(config, state)))
+    prune(config, state)
+    publish(config, state.catalog)
+    return state
+
+
+def merge(config, partial_filepaths):
+    """Publish the park content of a sharded build from the partial results
+    of all of its shards.
+
+    Raises OSError or ValueError if a partial result cannot be read or the
+    partial results do not cover every shard of one partition.
+    """
+    print('Merging ' + str(len(partial_filepaths)) + ' partial build results...')
+    settings = config.settings
+    catalog = ParkImageCatalog(
+        settings.DirPaths.dest_images, settings.ImageProcessing.output_instances)
+    merge_partials(partial_filepaths, catalog)
+
+    remove_extra_files(config, catalog)
+    publish(config, catalog)
+
+
+def remove_outputs(park_image_model):
+    for dest_filepath in park_image_model.get_dest_image_paths():
+        if os.path.isfile(dest_filepath):
+            os.remove(dest_filepath)
+
+
+def watch(config):
+    """Keep the image models in memory and rebuild whenever the source tree
+    or the park content JSON changes, until interrupted.
+
+    Only new and modified sources are re-read and rendered, outputs of
+    deleted sources are removed, and the content JS is only rewritten when
+    it would change.
+    """
+    check_encoder_profiles(config)
+
+    settings = config.settings
+    src_dirpath = settings.DirPaths.src_images
+    dest_dirpath = settings.DirPaths.dest_images
+    img_settings = settings.ImageProcessing
+    duplicate_distance = config.duplicate_distance
+
+    os.makedirs(dest_dirpath, exist_ok=True)
+    state = open_build_state(config)
+    watcher = SourceTreeWatcher(src_dirpath)
+    park_image_models = {}
+    # Sources that are rendered and published, i.e. not near-duplicates
+    published_filepaths = set()
+
+    park_content = None
+    park_content_mtime = None
+    park_content_js = None
+    content_module_writer = None
+    if config.content_modules_dirpath:
+        content_module_writer = ContentModuleWriter(config.content_modules_dirpath)
+    if os.path.isfile(settings.FilePaths.dest_park_content_js):
+        with open(settings.FilePaths.dest_park_content_js) as dest_park_content_file:
+            park_content_js = dest_park_content_file.read()
+
+    print('Watching ' + src_dirpath + ' for changes, press Ctrl+C to stop...')
+    try:
+        while True:
+            changes = watcher.poll()
+            content_changed = bool(changes)
+            if changes:
+                print()
+                print(str(len(changes.changed_filepaths)) + ' sources added or modified, ' +
+                      str(len(changes.deleted_filepaths)) + ' deleted')
+
+                for src_filepath in changes.deleted_filepaths:
+                    park_image_model = park_image_models.pop(src_filepath, None)
+                    if park_image_model:
+                        print('Removing outputs of ' + os.path.relpath(src_filepath, src_dirpath) + '...')
+                        remove_outputs(park_image_model)
+
+                for park_image_model in iter_park_image_models(
+                        changes.changed_filepaths, src_dirpath, dest_dirpath,
+                        img_settings.output_instances, state.metadata_index,
+                        perceptual_hashing=duplicate_distance is not None,
+                        max_source_pixels=getattr(img_settings, 'max_source_pixels', None)):
+                    park_image_models[park_image_model.src_filepath] = park_image_model
+
+                # Regroup near-duplicates, as adding or deleting a source can
+                # change which image represents a group
+                previous_published_filepaths = published_filepaths
+                published_park_image_models = [
+                    park_image_models[src_filepath] for src_filepath in changes.src_filepaths
+                    if src_filepath in park_image_models]
+                if duplicate_distance is not None:
+                    published_park_image_models = list(iter_unique_park_image_models(
+                        published_park_image_models, DuplicateIndex(duplicate_distance),
+                        src_dirpath))
+                published_filepaths = set(
+                    park_image_model.src_filepath for park_image_model in published_park_image_models)
+
+                for src_filepath in previous_published_filepaths - published_filepaths:
+                    if src_filepath in park_image_models:
+                        remove_outputs(park_image_models[src_filepath])
+
+                changed_filepaths = set(changes.changed_filepaths)
+                changed_park_image_models = [
+                    park_image_model for park_image_model in published_park_image_models
+                    if park_image_model.src_filepath in changed_filepaths or
+                    park_image_model.src_filepath not in previous_published_filepaths]
+
+                state.manifest.reused_count = 0
+                state.manifest.rebuilt_count = 0
+                # Sources that failed are retried once they change
+                state.failed_src_filepaths.difference_update(
+                    changed_filepaths, changes.deleted_filepaths)
+                render(config, state, plan(config, state, changed_park_image_models))
+
+                state.catalog = ParkImageCatalog(dest_dirpath, img_settings.output_instances)
+                for park_image_model in published_park_image_models:
+                    if park_image_model.src_filepath not in state.failed_src_filepaths:
+                        state.catalog.append(park_image_model)
+
+                state.metadata_index.prune(park_image_models)
+                state.metadata_index.save()
+                state.manifest.prune(
+                    state.catalog.iter_src_filepaths(), state.catalog.iter_dest_filepaths())
+                state.manifest.save()
+
+            src_park_content_mtime = os.stat(settings.FilePaths.src_park_content_json).st_mtime_ns
+            if src_park_content_mtime != park_content_mtime:
+                with open(settings.FilePaths.src_park_content_json) as src_park_content_file:
+                    park_content = json.load(src_park_content_file)
+                park_content_mtime = src_park_content_mtime
+                content_changed = True
+
+            if content_changed and content_module_writer:
+                save_park_content_modules(
+                    state.catalog, copy.deepcopy(park_content), settings, content_module_writer)
+            elif content_changed:
+                # Publish from a copy, as adding the images modifies the content
+                new_park_content_js = get_park_content_js(
+                    state.catalog, copy.deepcopy(park_content), settings)
+                if new_park_content_js != park_content_js:
+                    print('Saving park content JSON to destination JS...')
+                    with open(settings.FilePaths.dest_park_content_js, 'w') as dest_park_content_file:
+                        dest_park_content_file.write(new_park_content_js)
+                    park_content_js = new_park_content_js
+                else:
+                    print('Park content is unchanged')
+
+            time.sleep(config.poll_interval)
+    except KeyboardInterrupt:
+        print('Stopped watching')
@@ -0,0 +1,137 @@
+from array import array
+from datetime import datetime, timedelta
+import os
+import sys
+from ctg_builder.encoding import get_encoder_profiles
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class ParkImageCatalog:
+    """Compact, column-oriented store of every park image in a build.
+
+    Keeps only what publishing and pruning need once an image has been
+    rendered. Park names and source directories are interned and stored as
+    indices, dates as integer microseconds, and destination paths are
+    derived on demand from the base name and each instance's filename_add.
+    """
+
+    def __init__(self, dest_dirpath, img_output_instances):
+        self.dest_dirpath = dest_dirpath
+        self.filename_suffixes = [
+            (img_output_name, [
+                img_output_props.filename_add + encoder_profile.extension
+                for encoder_profile in get_encoder_profiles(img_output_props)])
+            for img_output_name, img_output_props in img_output_instances.items()]
+
+        self.park_names = []
+        self.src_dirpaths = []
+        self._park_name_indices = {}
+        self._src_dirpath_indices = {}
+        self._dest_file_base_name_set = None
+
+        # One entry per image in each column
+        self.park_name_indices = array('I')
+        self.src_dirpath_indices = array('I')
+        self.src_filenames = []
+        self.dest_file_base_names = []
+        self.dates_photo_taken = array('q')
+
+    def __len__(self):
+        return len(self.src_filenames)
+
+    def append(self, park_image):
+        self.append_record(
+            park_image.src_filepath, park_image.park_name,
+            (park_image.date_photo_taken - EPOCH) // timedelta(microseconds=1),
+            park_image.dest_file_base_name)
+
+    def append_record(self, src_filepath, park_name, date_photo_taken_us, dest_file_base_name):
+        src_dirpath, src_filename = os.path.split(src_filepath)
+
+        self.park_name_indices.append(get_interned_index(
+            park_name, self.park_names, self._park_name_indices))
+        self.src_dirpath_indices.append(get_interned_index(
+            src_dirpath, self.src_dirpaths, self._src_dirpath_indices))
+        self.src_filenames.append(src_filename)
+        self.dest_file_base_names.append(dest_file_base_name)
+        self.dates_photo_taken.append(date_photo_taken_us)
+        self._dest_file_base_name_set = None
+
+    def remove(self, src_filepaths):
+        """Remove the images of src_filepaths, keeping the rest in order."""
+        records = [self.get_record(i) for i in range(len(self))
+                   if self.get_src_filepath(i) not in src_filepaths]
+
+        self.park_name_indices = array('I')
+        self.src_dirpath_indices = array('I')
+        self.src_filenames = []
+        self.dest_file_base_names = []
+        self.dates_photo_taken = array('q')
+        for record in records:
+            self.append_record(*record)
+
+    def get_record(self, i):
+        """Get the columns of image i in the order append_record takes them."""
+        return (self.get_src_filepath(i), self.get_park_name(i),
+                self.dates_photo_taken[i], self.dest_file_base_names[i])
+
+    def get_park_name(self, i):
+        return self.park_names[self.park_name_indices[i]]
+
+    def get_src_filepath(self, i):
+        return os.path.join(
+            self.src_dirpaths[self.src_dirpath_indices[i]], self.src_filenames[i])
+
+    def get_date_photo_taken(self, i):
+        return EPOCH + timedelta(microseconds=self.dates_photo_taken[i])
+
+    def get_dest_filenames(self, i):
+        """Get (img_name, dest_filenames) for each output instance of image i,
+        with one filename per encoder profile, primary format first.
+        """
+        dest_file_base_name = self.dest_file_base_names[i]
+        return [(img_name, [dest_file_base_name + suffix for suffix in suffixes])
+                for img_name, suffixes in self.filename_suffixes]
+
+    def iter_src_filepaths(self):
+        for i in range(len(self)):
+            yield self.get_src_filepath(i)
+
+    def iter_dest_filepaths(self):
+        for i in range(len(self)):
+            for _, dest_filenames in self.get_dest_filenames(i):
+                for dest_filename in dest_filenames:
+                    yield os.path.join(self.dest_dirpath, dest_filename)
+
+    def contains_dest_filename(self, dest_filename):
+        """Check whether dest_filename is an output of any image, without
+        building the full set of destination paths.
+        """
+        if self._dest_file_base_name_set is None:
+            self._dest_file_base_name_set = set(self.dest_file_base_names)
+
+        for _, suffixes in self.filename_suffixes:
+            for suffix in suffixes:
+                if dest_filename.endswith(suffix) and \
+                        dest_filename[:-len(suffix)] in self._dest_file_base_name_set:
+                    return True
+        return False
+
+    def get_indices_by_park(self):
+        indices_by_park = {}
+        for i, park_name_index in enumerate(self.park_name_indices):
+            park_name = self.park_names[park_name_index]
+            if park_name not in indices_by_park:
+                indices_by_park[park_name] = array('I')
+            indices_by_park[park_name].append(i)
+        return indices_by_park
+
+
+def get_interned_index(value, values, indices):
+    index = indices.get(value)
+    if index is None:
+        index = len(values)
+        values.append(sys.intern(value))
+        indices[value] = index
+    return index
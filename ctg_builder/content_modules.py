@@ -0,0 +1,104 @@
+import hashlib
+import itertools
+import json
+import os
+import re
+from ctg_builder import utils
+
+INDEX_MODULE_FILENAME = 'index.js'
+CONTENT_HASHES_FILENAME = '.content_hashes.json'
+
+
+class ContentModuleWriter:
+    """Writes park content as a compact index module plus one module per
+    place, so the site only loads the places it shows.
+
+    Modules are encoded straight to a temporary file while being hashed and
+    only replace the existing module when the hash differs, so unchanged
+    places keep their files (and their cache entries on the site).
+    """
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self.written_count = 0
+        self.unchanged_count = 0
+
+        self.content_hashes = {}
+        content_hashes_filepath = os.path.join(dirpath, CONTENT_HASHES_FILENAME)
+        if os.path.isfile(content_hashes_filepath):
+            with open(content_hashes_filepath) as content_hashes_file:
+                self.content_hashes = json.load(content_hashes_file)
+
+    def write(self, park_content):
+        os.makedirs(self.dirpath, exist_ok=True)
+
+        content_hashes = {}
+        places_index = []
+        module_filenames = set()
+        for place in park_content.get('places', []):
+            module_filename = get_place_module_filename(place, module_filenames)
+            module_filenames.add(module_filename)
+            content_hashes[module_filename] = self.write_module(module_filename, place)
+
+            # The index keeps every place field except its images
+            place_index = {k: v for k, v in place.items() if k != 'images'}
+            place_index['module'] = module_filename
+            # Every output instance lists the same images
+            place_index['image_count'] = max(
+                [len(images) for images in place.get('images', {}).values()] or [0])
+            places_index.append(place_index)
+
+        index = dict(park_content)
+        index['places'] = places_index
+        content_hashes[INDEX_MODULE_FILENAME] = self.write_module(INDEX_MODULE_FILENAME, index)
+
+        # Remove modules of places that are gone
+        for module_filename in self.content_hashes:
+            if module_filename not in content_hashes:
+                module_filepath = os.path.join(self.dirpath, module_filename)
+                if os.path.isfile(module_filepath):
+                    os.remove(module_filepath)
+
+        self.content_hashes = content_hashes
+        tmp_filepath = os.path.join(self.dirpath, CONTENT_HASHES_FILENAME + '.tmp')
+        with open(tmp_filepath, 'w') as content_hashes_file:
+            json.dump(content_hashes, content_hashes_file)
+        os.replace(tmp_filepath, os.path.join(self.dirpath, CONTENT_HASHES_FILENAME))
+
+    def write_module(self, module_filename, content):
+        """Write content as a module unless an identical one exists, and get
+        its content hash.
+        """
+        module_filepath = os.path.join(self.dirpath, module_filename)
+        tmp_filepath = module_filepath + '.tmp'
+
+        content_hash = hashlib.sha1()
+        encoder = utils.DateTimeEncoder(separators=(',', ':'))
+        with open(tmp_filepath, 'w') as module_file:
+            for chunk in itertools.chain(
+                    ['module.exports = '], encoder.iterencode(content), [';']):
+                module_file.write(chunk)
+                content_hash.update(chunk.encode('utf-8'))
+        content_hash = content_hash.hexdigest()
+
+        if content_hash == self.content_hashes.get(module_filename) and \
+                os.path.isfile(module_filepath):
+            os.remove(tmp_filepath)
+            self.unchanged_count += 1
+        else:
+            os.replace(tmp_filepath, module_filepath)
+            self.written_count += 1
+        return content_hash
+
+
+def get_place_module_filename(place, taken_filenames):
+    """Get a filename for the module of place from its name, unique among
+    taken_filenames.
+    """
+    slug = re.sub(r'[^a-z0-9]+', '-', str(place.get('name', '')).lower()).strip('-') or 'place'
+    module_filename = slug + '.js'
+    suffix = 2
+    while module_filename in taken_filenames or module_filename == INDEX_MODULE_FILENAME:
+        module_filename = slug + '-' + str(suffix) + '.js'
+        suffix += 1
+    return module_filename
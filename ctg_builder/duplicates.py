@@ -0,0 +1,119 @@
+from PIL import Image
+from ctg_builder import utils
+
+# Width and height of the gradient grid a difference hash is computed on,
+# giving a hash of DHASH_SIZE * DHASH_SIZE bits
+DHASH_SIZE = 8
+
+
+def get_dhash(src_filepath, max_pixels=None):
+    """Get the difference hash of an image: one bit per pair of horizontally
+    adjacent pixels of a tiny grayscale copy, set where brightness increases.
+
+    Near-identical frames, such as burst shots or re-exports of the same
+    photo, get hashes that differ in only a few bits.
+
+    Sources over max_pixels are decoded as memory-bounded as when they are
+    rendered. Returns None for those that cannot be decoded that way.
+    """
+    # Imported here so discovery only loads the renderer when it hashes
+    from ctg_builder.rendering import SourceTooLargeError, open_bounded_source_image
+
+    with utils.open_image_lazily(src_filepath, max_pixels) as img:
+        if max_pixels and img.width * img.height > max_pixels:
+            try:
+                img, _ = open_bounded_source_image(
+                    img, DHASH_SIZE * 8, DHASH_SIZE * 8, max_pixels)
+            except SourceTooLargeError:
+                return None
+        else:
+            # Decoding a JPEG at reduced scale is enough for a 9x8 thumbnail
+            img.draft('L', (DHASH_SIZE * 8, DHASH_SIZE * 8))
+        small_img = img.convert('L').resize(
+            (DHASH_SIZE + 1, DHASH_SIZE), Image.BILINEAR, reducing_gap=2.0)
+
+    pixels = small_img.tobytes()
+    dhash = 0
+    for y in range(DHASH_SIZE):
+        row = pixels[y * (DHASH_SIZE + 1):(y + 1) * (DHASH_SIZE + 1)]
+        for x in range(DHASH_SIZE):
+            dhash = (dhash << 1) | (row[x + 1] > row[x])
+    return dhash
+
+
+def get_hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class BKTree:
+    """Burkhard-Keller tree of hashes under the Hamming distance, for
+    finding the hashes within a distance of a query without comparing it
+    to every one of them.
+    """
+
+    def __init__(self):
+        # Each node is [hash, item, {distance: child node}]
+        self.root = None
+
+    def add(self, item_hash, item):
+        if self.root is None:
+            self.root = [item_hash, item, {}]
+            return
+
+        node = self.root
+        while True:
+            distance = get_hamming_distance(item_hash, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [item_hash, item, {}]
+                return
+            node = child
+
+    def find_nearest(self, item_hash, max_distance):
+        """Get (distance, item) of the nearest hash within max_distance, or
+        None if there is none.
+        """
+        nearest = None
+        nodes = [self.root] if self.root else []
+        while nodes:
+            node = nodes.pop()
+            distance = get_hamming_distance(item_hash, node[0])
+            if distance <= max_distance and (nearest is None or distance < nearest[0]):
+                nearest = (distance, node[1])
+
+            # By the triangle inequality only these subtrees can hold matches
+            for child_distance, child in node[2].items():
+                if abs(child_distance - distance) <= max_distance:
+                    nodes.append(child)
+        return nearest
+
+
+class DuplicateIndex:
+    """Groups park images whose perceptual hashes are within max_distance
+    bits of each other, within each park.
+
+    The first image of a group to be added is its representative, so with a
+    stable discovery order the same image represents a group on every run.
+    """
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        self.trees_by_park = {}
+        self.duplicate_filepaths = []
+
+    def find_or_add(self, park_image):
+        """Get (distance, representative source path) if park_image is a
+        near-duplicate of an image already in the index, otherwise add it as
+        the representative of a new group and return None.
+        """
+        if park_image.perceptual_hash is None:
+            return None
+
+        tree = self.trees_by_park.setdefault(park_image.park_name, BKTree())
+        nearest = tree.find_nearest(park_image.perceptual_hash, self.max_distance)
+        if nearest:
+            self.duplicate_filepaths.append(park_image.src_filepath)
+            return nearest
+
+        tree.add(park_image.perceptual_hash, park_image.src_filepath)
+        return None
@@ -0,0 +1,73 @@
+from PIL import Image
+
+EXTENSIONS = {
+    'JPEG': '.jpg',
+    'WEBP': '.webp',
+    'AVIF': '.avif'
+}
+
+
+class EncoderProfile:
+    """How one output instance is encoded.
+
+    Options left as None use the encoder's defaults, except quality, which
+    falls back to ImageProcessing.jpeg_quality. Format-specific Pillow save
+    options (e.g. method for WebP or speed for AVIF) can be passed as extra
+    keyword arguments.
+    """
+
+    def __init__(self, format='JPEG', quality=None, optimize=None, progressive=None, subsampling=None, **save_params):
+        self.format = format.upper()
+        self.quality = quality
+        self.optimize = optimize
+        self.progressive = progressive
+        self.subsampling = subsampling
+        self.save_params = save_params
+
+    @property
+    def name(self):
+        return self.format.lower()
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.format]
+
+    def is_supported(self):
+        Image.init()
+        return self.format in EXTENSIONS and self.format in Image.SAVE
+
+    def get_save_params(self, img_settings):
+        save_params = {
+            'quality': self.quality if self.quality is not None else img_settings.jpeg_quality
+        }
+        if self.optimize is not None:
+            save_params['optimize'] = self.optimize
+        if self.progressive is not None:
+            save_params['progressive'] = self.progressive
+        if self.subsampling is not None:
+            save_params['subsampling'] = self.subsampling
+        save_params.update(self.save_params)
+        return save_params
+
+    def get_params(self):
+        return {
+            'format': self.format,
+            'quality': self.quality,
+            'optimize': self.optimize,
+            'progressive': self.progressive,
+            'subsampling': self.subsampling,
+            'save_params': self.save_params
+        }
+
+
+# Used for instances that do not declare encoder_profiles
+DEFAULT_ENCODER_PROFILES = [
+    EncoderProfile('JPEG', optimize=True, progressive=True)
+]
+
+
+def get_encoder_profiles(instance_settings):
+    """Get the encoder profiles of an output instance. The first one is the
+    primary format, which is published as the image's path.
+    """
+    return getattr(instance_settings, 'encoder_profiles', None) or DEFAULT_ENCODER_PROFILES
@@ -1,9 +1,13 @@
-from PIL import ImageStat, ImageEnhance, ImageOps
+from PIL import Image, ImageStat, ImageEnhance, ImageOps
 import operator
 import functools
 import math
 from ctg_builder import utils
 
+# Largest relative difference allowed between enhancement factors measured
+# on a proxy image and on the full resolution image
+PROXY_FACTOR_TOLERANCE = 0.02
+
 
 class FactorDeterminer:
 
@@ -14,6 +18,15 @@ class FactorDeterminer:
         self.avg_count = avg_count
         self.cutoff = cutoff
 
+    def get_params(self):
+        return {
+            'max_val': self.max_val,
+            'min_val': self.min_val,
+            'target_val': self.target_val,
+            'avg_count': self.avg_count,
+            'cutoff': self.cutoff
+        }
+
     def determine(self, orig_val):
         if self.max_val is not None and orig_val > self.max_val:
             factors = [self.max_val / orig_val]
@@ -41,20 +54,39 @@ class EnhancementAlgorithm:
         self.enhancement_type = enhancement_type
         self.factor_determiner = factor_determiner
 
-    def enhance(self, img):
-        enhancer = None
+    def get_params(self):
+        return {
+            'enhancement_type': self.enhancement_type,
+            'factor_determiner': self.factor_determiner.get_params()
+        }
+
+    def determine_factor(self, img):
+        """Measure img and get the factor this algorithm would apply to it.
+
+        Returns None for algorithms that do not use a factor.
+        """
         if self.enhancement_type is EnhancementType.Brightness:
             orig_val = get_brightness(img)
-            enhancer = ImageEnhance.Brightness(img)
-            print('orig_brightness = ' + str(orig_val))
 
         elif self.enhancement_type is EnhancementType.Saturation:
             orig_val = get_saturation(img)
+
+        else:
+            return None
+
+        return self.factor_determiner.determine(orig_val)
+
+    def enhance(self, img, factor=None):
+        enhancer = None
+        if self.enhancement_type is EnhancementType.Brightness:
+            enhancer = ImageEnhance.Brightness(img)
+
+        elif self.enhancement_type is EnhancementType.Saturation:
             enhancer = ImageEnhance.Color(img)
-            print('orig_saturation = ' + str(orig_val))
 
         if enhancer:
-            factor = self.factor_determiner.determine(orig_val)
+            if factor is None:
+                factor = self.determine_factor(img)
             return enhancer.enhance(factor)
         else:
             if self.enhancement_type is EnhancementType.AutoContrast:
@@ -77,14 +109,53 @@ class EnhancementAlgorithmList:
         self.name = name
         self.enhancement_algorithms = enhancement_algorithms
 
-    def enhance(self, img):
+    def get_params(self):
+        return [enhancement_algorithm.get_params()
+                for enhancement_algorithm in self.enhancement_algorithms]
+
+    def determine_factors(self, img):
+        """Get the factor of every algorithm in the list by running the list
+        on img, which is usually a small proxy of the image to enhance.
+        """
+        factors = []
         result_img = img
         for enhancement_algorithm in self.enhancement_algorithms:
-            result_img = enhancement_algorithm.enhance(result_img)
+            factor = enhancement_algorithm.determine_factor(result_img)
+            result_img = enhancement_algorithm.enhance(result_img, factor)
+            factors.append(factor)
+
+        return factors
+
+    def enhance(self, img, factors=None):
+        result_img = img
+        for i, enhancement_algorithm in enumerate(self.enhancement_algorithms):
+            factor = factors[i] if factors else None
+            result_img = enhancement_algorithm.enhance(result_img, factor)
 
         return result_img
 
 
+def get_proxy_image(img, proxy_size):
+    """Get a copy of img downscaled to fit in proxy_size x proxy_size."""
+    scale = proxy_size / max(img.width, img.height)
+    if scale >= 1:
+        return img
+
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.BILINEAR, reducing_gap=2.0)
+
+
+def get_factor_error(proxy_factors, full_factors):
+    """Get the largest relative difference between two lists of factors."""
+    max_error = 0
+    for proxy_factor, full_factor in zip(proxy_factors, full_factors):
+        if proxy_factor is None or full_factor is None:
+            continue
+        max_error = max(max_error, abs(proxy_factor - full_factor) / full_factor)
+
+    return max_error
+
+
 # Sourced from http://stackoverflow.com/a/7170023
 def equalize(img):
     h = img.convert("L").histogram()
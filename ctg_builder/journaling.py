@@ -0,0 +1,45 @@
+import json
+import os
+
+CHECKPOINT_JOURNAL_SUFFIX = '.journal'
+
+
+class CheckpointJournal:
+    """Append-only log of the changes made to a state file since it was last
+    saved, one compact JSON record per line.
+
+    Records are written as soon as they are made, so a run that is killed
+    before it saves the state file can replay them on the next load.
+    """
+
+    def __init__(self, state_filepath):
+        self.filepath = state_filepath + CHECKPOINT_JOURNAL_SUFFIX
+        self.file = None
+
+    def iter_records(self):
+        if not os.path.isfile(self.filepath):
+            return
+
+        with open(self.filepath) as journal_file:
+            for line in journal_file:
+                # Skip a record the run was killed in the middle of writing
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def append(self, record):
+        if self.file is None:
+            # Line buffered, so each record reaches the file as it is made.
+            # Start on a new line in case the last run stopped mid-record.
+            self.file = open(self.filepath, 'a', buffering=1)
+            self.file.write('\n')
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def clear(self):
+        """Remove the journal once the state file holds all of its records."""
+        if self.file:
+            self.file.close()
+            self.file = None
+        if os.path.isfile(self.filepath):
+            os.remove(self.filepath)
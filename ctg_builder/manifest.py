@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+from ctg_builder.journaling import CheckpointJournal
+
+MANIFEST_FILENAME = '.build_manifest.json'
+MANIFEST_VERSION = 1
+
+# Record types of the checkpoint journal
+JOURNAL_SOURCE = 's'
+JOURNAL_OUTPUT = 'o'
+
+
+class SourceKey:
+
+    def __init__(self, size, mtime, content_hash):
+        self.size = size
+        self.mtime = mtime
+        self.content_hash = content_hash
+
+    def to_dict(self):
+        return {
+            'size': self.size,
+            'mtime': self.mtime,
+            'hash': self.content_hash
+        }
+
+
+class BuildManifest:
+    """Persistent record of the inputs each destination image was built from.
+
+    An output is reused only when the destination file exists and both the
+    source key (size, mtime and content hash) and the settings fingerprint
+    match what was recorded when it was last written.
+
+    Between saves, every hashed source and written output is also appended
+    to a checkpoint journal next to the manifest. The journal is replayed
+    on load, so a run that was killed before it could save the manifest
+    resumes without rehashing sources or rendering outputs again.
+
+    Whether outputs exist is looked up in one listing of each destination
+    directory rather than with a stat per output.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.journal = CheckpointJournal(filepath)
+        self.sources = {}
+        self.outputs = {}
+        self.reused_count = 0
+        self.rebuilt_count = 0
+        self.replayed_count = 0
+        self.filenames_by_dirpath = {}
+
+        if os.path.isfile(filepath):
+            with open(filepath) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.sources = manifest['sources']
+                self.outputs = manifest['outputs']
+
+        # Apply the records of a run that stopped before saving
+        for record in self.journal.iter_records():
+            if record[0] == JOURNAL_SOURCE:
+                _, src_filepath, size, mtime, content_hash = record
+                self.sources[src_filepath] = SourceKey(size, mtime, content_hash).to_dict()
+            elif record[0] == JOURNAL_OUTPUT:
+                _, dest_filepath, size, mtime, content_hash, settings_fingerprint = record
+                self.outputs[dest_filepath] = {
+                    'source': SourceKey(size, mtime, content_hash).to_dict(),
+                    'settings': settings_fingerprint
+                }
+                self.replayed_count += 1
+
+    def get_source_key(self, src_filepath, rehash=True):
+        """Get the source key of src_filepath. Unless rehash is set, a
+        source whose size or mtime changed is not read and gets a key with no
+        content hash, which matches no recorded output.
+        """
+        stat = os.stat(src_filepath)
+
+        # Only rehash the source when its size or mtime changed
+        cached = self.sources.get(src_filepath)
+        if cached and cached['size'] == stat.st_size and \
+                cached['mtime'] == stat.st_mtime_ns:
+            content_hash = cached['hash']
+        elif rehash:
+            content_hash = get_file_hash(src_filepath)
+            self.journal.append(
+                [JOURNAL_SOURCE, src_filepath, stat.st_size, stat.st_mtime_ns, content_hash])
+        else:
+            return SourceKey(stat.st_size, stat.st_mtime_ns, None)
+
+        source_key = SourceKey(stat.st_size, stat.st_mtime_ns, content_hash)
+        self.sources[src_filepath] = source_key.to_dict()
+        return source_key
+
+    def is_up_to_date(self, dest_filepath, source_key, settings_fingerprint):
+        output = self.outputs.get(dest_filepath)
+        if not output:
+            return False
+        if output['source'] != source_key.to_dict():
+            return False
+        if output['settings'] != settings_fingerprint:
+            return False
+        return self.exists(dest_filepath)
+
+    def exists(self, dest_filepath):
+        dirpath, filename = os.path.split(dest_filepath)
+        if dirpath not in self.filenames_by_dirpath:
+            try:
+                self.filenames_by_dirpath[dirpath] = set(os.listdir(dirpath))
+            except FileNotFoundError:
+                self.filenames_by_dirpath[dirpath] = set()
+        return filename in self.filenames_by_dirpath[dirpath]
+
+    def record(self, dest_filepath, source_key, settings_fingerprint):
+        self.outputs[dest_filepath] = {
+            'source': source_key.to_dict(),
+            'settings': settings_fingerprint
+        }
+        self.journal.append(
+            [JOURNAL_OUTPUT, dest_filepath, source_key.size, source_key.mtime,
+             source_key.content_hash, settings_fingerprint])
+
+    def prune(self, src_filepaths, dest_filepaths):
+        """Drop entries for sources and outputs that are no longer built."""
+        src_filepaths = set(src_filepaths)
+        dest_filepaths = set(dest_filepaths)
+        self.sources = {
+            k: v for k, v in self.sources.items() if k in src_filepaths}
+        self.outputs = {
+            k: v for k, v in self.outputs.items() if k in dest_filepaths}
+
+    def save(self):
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'sources': self.sources,
+            'outputs': self.outputs
+        }
+
+        # Write to a temporary file first so an interrupted save cannot
+        # leave a truncated manifest behind
+        tmp_filepath = self.filepath + '.tmp'
+        with open(tmp_filepath, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(tmp_filepath, self.filepath)
+
+        # The manifest now holds everything the journal recorded
+        self.journal.clear()
+
+        # Outputs may be removed between builds, e.g. in watch mode
+        self.filenames_by_dirpath = {}
+
+
+def get_file_hash(filepath, chunk_size=1024 * 1024):
+    file_hash = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_settings_fingerprint(instance_settings, img_settings, encoder_profile):
+    """Hash every setting that affects the bytes of one output file."""
+    settings_params = {
+        'img_width': instance_settings.img_width,
+        'img_height': instance_settings.img_height,
+        'watermark_font_size': instance_settings.watermark_font_size,
+        'enhancement_algorithm_list':
+            instance_settings.enhancement_algorithm_list.get_params(),
+        'enhancement_engine': getattr(instance_settings, 'enhancement_engine', 'pil'),
+        'proxy_stats_size': getattr(img_settings, 'proxy_stats_size', None),
+        # Over-budget sources are decoded at a scale that depends on it
+        'max_source_pixels': getattr(img_settings, 'max_source_pixels', None),
+        'cascade_rendering': getattr(img_settings, 'cascade_rendering', False),
+        'cascade_watermark': getattr(img_settings, 'cascade_watermark', 'last'),
+        'encoder_profile': encoder_profile.get_params(),
+        'jpeg_quality': img_settings.jpeg_quality,
+        'watermark': {
+            'text': img_settings.Watermark.text,
+            'rgb': list(img_settings.Watermark.rgb),
+            # None stands for the default font, which keeps the renderer's
+            # font handling out of planning
+            'font_filepath': getattr(img_settings.Watermark, 'font_filepath', None)
+        }
+    }
+
+    settings_json = json.dumps(settings_params, sort_keys=True)
+    return hashlib.sha1(settings_json.encode('utf-8')).hexdigest()
@@ -0,0 +1,93 @@
+from datetime import datetime
+import json
+import os
+from ctg_builder.journaling import CheckpointJournal
+
+METADATA_INDEX_FILENAME = '.metadata_index.json'
+METADATA_INDEX_VERSION = 1
+
+
+class ParkImageMetadata:
+
+    def __init__(self, park_name, date_photo_taken, dest_file_base_name, perceptual_hash=None, pixel_count=None):
+        self.park_name = park_name
+        self.date_photo_taken = date_photo_taken
+        self.dest_file_base_name = dest_file_base_name
+        self.perceptual_hash = perceptual_hash
+        self.pixel_count = pixel_count
+
+
+class MetadataIndex:
+    """On-disk cache of the per-source metadata ParkImage needs.
+
+    Entries are keyed on source path and only used while the file's size and
+    mtime still match, so warm runs never have to open the image itself.
+    New entries are also appended to a checkpoint journal until the index is
+    saved, so a killed run does not have to read them again. Read-only users,
+    such as a dry run, pass journaled=False.
+    """
+
+    def __init__(self, filepath, journaled=True):
+        self.filepath = filepath
+        self.journal = CheckpointJournal(filepath)
+        self.journaled = journaled
+        self.entries = {}
+        self.hit_count = 0
+        self.miss_count = 0
+
+        if os.path.isfile(filepath):
+            with open(filepath) as index_file:
+                index = json.load(index_file)
+            if index.get('version') == METADATA_INDEX_VERSION:
+                self.entries = index['entries']
+
+        # Apply the entries of a run that stopped before saving
+        for src_filepath, entry in self.journal.iter_records():
+            self.entries[src_filepath] = entry
+
+    def get(self, src_filepath, stat):
+        entry = self.entries.get(src_filepath)
+        if not entry or entry['size'] != stat.st_size or \
+                entry['mtime'] != stat.st_mtime_ns:
+            self.miss_count += 1
+            return None
+
+        self.hit_count += 1
+        return ParkImageMetadata(
+            park_name=entry['park_name'],
+            date_photo_taken=datetime.fromisoformat(entry['date_photo_taken']),
+            dest_file_base_name=entry['dest_file_base_name'],
+            perceptual_hash=entry.get('perceptual_hash'),
+            pixel_count=entry.get('pixel_count'))
+
+    def put(self, src_filepath, stat, metadata):
+        entry = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'park_name': metadata.park_name,
+            'date_photo_taken': metadata.date_photo_taken.isoformat(),
+            'dest_file_base_name': metadata.dest_file_base_name,
+            'perceptual_hash': metadata.perceptual_hash,
+            'pixel_count': metadata.pixel_count
+        }
+        self.entries[src_filepath] = entry
+        if self.journaled:
+            self.journal.append([src_filepath, entry])
+
+    def prune(self, src_filepaths):
+        """Drop entries for sources that no longer exist."""
+        src_filepaths = set(src_filepaths)
+        self.entries = {
+            k: v for k, v in self.entries.items() if k in src_filepaths}
+
+    def save(self):
+        index = {
+            'version': METADATA_INDEX_VERSION,
+            'entries': self.entries
+        }
+
+        tmp_filepath = self.filepath + '.tmp'
+        with open(tmp_filepath, 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(tmp_filepath, self.filepath)
+        self.journal.clear()
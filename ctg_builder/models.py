@@ -1,67 +1,142 @@
 import os
 import hashlib
 from ctg_builder import utils
+from ctg_builder.duplicates import get_dhash
+from ctg_builder.encoding import get_encoder_profiles
+from ctg_builder.metadata_index import ParkImageMetadata
 
 
 class ParkImage:
 
-    def __init__(self, src_filepath, src_dirpath, dest_dirpath, img_output_instances):
+    __slots__ = ('src_filepath', 'park_name', 'date_photo_taken',
+                 'dest_file_base_name', 'perceptual_hash', 'pixel_count',
+                 'dest_instances')
+
+    def __init__(self, src_filepath, src_dirpath, dest_dirpath, img_output_instances, metadata_index=None, perceptual_hashing=False, max_source_pixels=None):
         self.src_filepath = src_filepath
 
-        # Get filename for src_filepath
-        src_filename = os.path.basename(self.src_filepath)
-
-        # Get the last 4 digits of the image number contained in the file name
-        src_img_number = utils.get_numeric_part_from_string(src_filename)[-4:]
-
-        # Get parent directory for src_filepath
-        src_file_dir_path = os.path.dirname(self.src_filepath)
-
-        # Get path relative to source root/start path (the part that comes
-        # after the root path)
-        start_rel_path = os.path.relpath(src_file_dir_path, src_dirpath)
-
-        # Get park name from name of first directory in start_rel_path
-        # Get season name from name of second directory in start_rel_path
-        start_rel_path_dirs = os.path.normpath(start_rel_path).split(os.sep)
-        self.park_name = start_rel_path_dirs[0]
-
-        # Get photo date
-        date_photo_taken = utils.get_date_photo_taken(self.src_filepath)
-        date_file_modified = utils.get_date_modified(self.src_filepath)
-        self.date_photo_taken = date_photo_taken or date_file_modified
-
-        # Build destination paths
-        # Use hash of source directory to maintain a small correlation
-        # between source path and destination filename.
-        # This should allow deleting individual destination images
-        # and re-running the process quickly.
-        # But still want to maintain order of files, so will use
-        # actual src_img_number as next part.
-        start_rel_path_hash = hashlib.md5(
-            start_rel_path.encode('utf-8')).hexdigest()[:10]
-        dest_file_base_name = 'img-' + \
-            start_rel_path_hash + '-' + src_img_number
+        # Use cached metadata when the source is unchanged since it was indexed
+        metadata = None
+        if metadata_index is not None:
+            src_stat = os.stat(self.src_filepath)
+            metadata = metadata_index.get(self.src_filepath, src_stat)
+
+        metadata_changed = False
+        if metadata is None:
+            metadata = get_park_image_metadata(self.src_filepath, src_dirpath, max_source_pixels)
+            metadata_changed = True
+
+        # Only decode the image for its hash when duplicates are looked for
+        if perceptual_hashing and metadata.perceptual_hash is None:
+            metadata.perceptual_hash = get_dhash(self.src_filepath, max_source_pixels)
+            metadata_changed = True
+
+        # Entries indexed before pixel counts were recorded lack them
+        if metadata.pixel_count is None:
+            _, metadata.pixel_count = utils.read_header_metadata(
+                self.src_filepath, max_source_pixels)
+            metadata_changed = True
+
+        if metadata_changed and metadata_index is not None:
+            metadata_index.put(self.src_filepath, src_stat, metadata)
+
+        self.park_name = metadata.park_name
+        self.date_photo_taken = metadata.date_photo_taken
+        self.dest_file_base_name = metadata.dest_file_base_name
+        self.perceptual_hash = metadata.perceptual_hash
+        self.pixel_count = metadata.pixel_count
 
         # Add dest instance for each image destination
         self.dest_instances = []
 
         for img_output_name, img_output_props in img_output_instances.items():
-            dest_filename = dest_file_base_name + \
-                img_output_props.filename_add + ".jpg"
-            dest_filepath = os.path.join(dest_dirpath, dest_filename)
+            # One file per encoder profile of the instance
+            dest_filepaths = []
+            for encoder_profile in get_encoder_profiles(img_output_props):
+                dest_filename = self.dest_file_base_name + \
+                    img_output_props.filename_add + encoder_profile.extension
+                dest_filepaths.append(os.path.join(dest_dirpath, dest_filename))
             self.dest_instances.append(
-                ParkImageDestinationInstance(img_output_name, dest_filepath))
+                ParkImageDestinationInstance(img_output_name, dest_filepaths))
 
     def get_dest_image_paths(self):
         dest_filepaths = []
         for dest_instance in self.dest_instances:
-            dest_filepaths.append(dest_instance.filepath)
+            dest_filepaths.extend(dest_instance.filepaths)
         return dest_filepaths
 
 
 class ParkImageDestinationInstance:
 
-    def __init__(self, img_name, dest_filepath):
+    __slots__ = ('img_name', 'filepaths')
+
+    def __init__(self, img_name, dest_filepaths):
         self.img_name = img_name
-        self.filepath = dest_filepath
+        # One path per encoder profile, in the order of the instance's
+        # encoder_profiles
+        self.filepaths = dest_filepaths
+
+    @property
+    def filepath(self):
+        """Path of the primary format."""
+        return self.filepaths[0]
+
+
+class RenderJob:
+
+    def __init__(self, park_image_model, dest_instances, source_key):
+        self.park_image_model = park_image_model
+        self.dest_instances = dest_instances
+        self.source_key = source_key
+
+
+def get_park_image_metadata(src_filepath, src_dirpath, max_source_pixels=None):
+    # Get filename for src_filepath
+    src_filename = os.path.basename(src_filepath)
+
+    # Get the last 4 digits of the image number contained in the file name
+    src_img_number = utils.get_numeric_part_from_string(src_filename)[-4:]
+
+    start_rel_path = get_start_rel_path(src_filepath, src_dirpath)
+    park_name = get_park_name(start_rel_path)
+
+    # Get photo date
+    date_photo_taken, pixel_count = utils.read_header_metadata(src_filepath, max_source_pixels)
+    date_file_modified = utils.get_date_modified(src_filepath)
+
+    # Build destination paths
+    # Use hash of source directory to maintain a small correlation
+    # between source path and destination filename.
+    # This should allow deleting individual destination images
+    # and re-running the process quickly.
+    # But still want to maintain order of files, so will use
+    # actual src_img_number as next part.
+    start_rel_path_hash = get_start_rel_path_hash(start_rel_path)
+    dest_file_base_name = 'img-' + \
+        start_rel_path_hash + '-' + src_img_number
+
+    return ParkImageMetadata(
+        park_name=park_name,
+        date_photo_taken=date_photo_taken or date_file_modified,
+        dest_file_base_name=dest_file_base_name,
+        pixel_count=pixel_count)
+
+
+def get_start_rel_path(src_filepath, src_dirpath):
+    # Get parent directory for src_filepath
+    src_file_dir_path = os.path.dirname(src_filepath)
+
+    # Get path relative to source root/start path (the part that comes
+    # after the root path)
+    return os.path.relpath(src_file_dir_path, src_dirpath)
+
+
+def get_park_name(start_rel_path):
+    # Get park name from name of first directory in start_rel_path
+    # Get season name from name of second directory in start_rel_path
+    start_rel_path_dirs = os.path.normpath(start_rel_path).split(os.sep)
+    return start_rel_path_dirs[0]
+
+
+def get_start_rel_path_hash(start_rel_path):
+    return hashlib.md5(start_rel_path.encode('utf-8')).hexdigest()[:10]
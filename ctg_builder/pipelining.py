@@ -0,0 +1,191 @@
+"""Pipelined rendering with overlapped reads, rendering and writes.
+
+Sources are read by a prefetch thread, decoded and rendered by the
+rendering stage (in-process or in a worker pool) and written by a writer
+thread. The stages are connected by bounded queues, and a shared memory
+budget on the bytes held in flight stops the prefetch thread from running
+ahead of the rest of the pipeline.
+"""
+from collections import deque
+import functools
+import os
+import queue
+import threading
+import time
+
+from ctg_builder.rendering import ParkImageRenderResult, render_park_image
+
+_END = object()
+
+# How long the renderer waits for the next source while jobs are pending in
+# the pool before it collects the oldest one
+PENDING_POLL_INTERVAL = 0.05
+
+
+class MemoryBudget:
+    """Counts bytes held in flight and blocks acquire() while over budget."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight_bytes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, byte_count):
+        with self._condition:
+            # Always let a single item through, even if it is larger than
+            # the whole budget, so oversized sources cannot stall the run
+            while self.in_flight_bytes > 0 and \
+                    self.in_flight_bytes + byte_count > self.max_bytes:
+                self._condition.wait()
+            self.in_flight_bytes += byte_count
+
+    def add(self, byte_count):
+        """Count bytes that are already in memory, without waiting."""
+        with self._condition:
+            self.in_flight_bytes += byte_count
+
+    def release(self, byte_count):
+        with self._condition:
+            self.in_flight_bytes -= byte_count
+            self._condition.notify_all()
+
+
+class PipelineStage(threading.Thread):
+    """Thread that records the first exception of its stage so the
+    consumer can re-raise it.
+    """
+
+    def __init__(self, name, target, output_queue):
+        super().__init__(name=name, daemon=True)
+        self._target_func = target
+        self.output_queue = output_queue
+        self.error = None
+
+    def run(self):
+        try:
+            self._target_func()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.output_queue.put(_END)
+
+
+def render_pipelined(render_jobs, img_settings, memory_budget_bytes, pool=None, worker_count=1):
+    """Render render_jobs through the read, render and write stages.
+
+    Yields a ParkImageRenderResult per job, in job order, once its outputs
+    have been written.
+    """
+    memory_budget = MemoryBudget(memory_budget_bytes)
+    read_queue = queue.Queue(maxsize=worker_count * 2)
+    write_queue = queue.Queue(maxsize=worker_count * 2)
+    done_queue = queue.Queue()
+    render = functools.partial(render_park_image, img_settings=img_settings)
+
+    def read_sources():
+        for render_job in render_jobs:
+            memory_budget.acquire(render_job.source_key.size)
+            start_time = time.perf_counter()
+            try:
+                with open(render_job.park_image_model.src_filepath, 'rb') as src_file:
+                    src_bytes = src_file.read()
+            except OSError as e:
+                memory_budget.release(render_job.source_key.size)
+                result = ParkImageRenderResult(render_job)
+                result.error = type(e).__name__ + ': ' + str(e)
+                read_queue.put((render_job, None, result))
+                continue
+            read_time = time.perf_counter() - start_time
+            read_queue.put((render_job, src_bytes, read_time))
+
+    def finish_render(render_job, result, read_time):
+        memory_budget.release(render_job.source_key.size)
+        result.profile.stage_timings.append(('read', None, read_time))
+        memory_budget.add(get_encoded_byte_count(result))
+        write_queue.put(result)
+
+    def render_sources():
+        pending = deque()
+        while True:
+            try:
+                item = read_queue.get(timeout=PENDING_POLL_INTERVAL if pending else None)
+            except queue.Empty:
+                # The pending jobs hold their source bytes in the budget, so
+                # the reader may be waiting for one of them to finish
+                render_job, read_time, async_result = pending.popleft()
+                finish_render(render_job, async_result.get(), read_time)
+                continue
+            if item is _END:
+                break
+
+            render_job, src_bytes, read_time = item
+            if src_bytes is None:
+                # The read failed and read_time holds the failed result
+                write_queue.put(read_time)
+                continue
+
+            if pool is None:
+                finish_render(
+                    render_job, render(render_job, src_bytes=src_bytes), read_time)
+                continue
+
+            pending.append((render_job, read_time, pool.apply_async(
+                render, (render_job,), {'src_bytes': src_bytes})))
+            while len(pending) >= worker_count or (pending and pending[0][2].ready()):
+                render_job, read_time, async_result = pending.popleft()
+                finish_render(render_job, async_result.get(), read_time)
+
+        while pending:
+            render_job, read_time, async_result = pending.popleft()
+            finish_render(render_job, async_result.get(), read_time)
+
+        if reader.error:
+            raise reader.error
+
+    def write_outputs():
+        while True:
+            result = write_queue.get()
+            if result is _END:
+                break
+
+            encoded_byte_count = get_encoded_byte_count(result)
+            result.rendered_instances = []
+            try:
+                for dest_instance, dest_filepath, encoded_bytes in result.encoded_outputs:
+                    with result.profile.stage('write', dest_instance.img_name):
+                        os.makedirs(os.path.dirname(dest_filepath), exist_ok=True)
+                        with open(dest_filepath, 'wb') as dest_file:
+                            dest_file.write(encoded_bytes)
+                    result.profile.bytes_written += len(encoded_bytes)
+                    # An instance counts as rendered once all its formats are written
+                    if dest_filepath == dest_instance.filepaths[-1]:
+                        result.rendered_instances.append(dest_instance)
+            except OSError as e:
+                result.error = type(e).__name__ + ': ' + str(e)
+
+            result.encoded_outputs = []
+            memory_budget.release(encoded_byte_count)
+            done_queue.put(result)
+
+        if renderer.error:
+            raise renderer.error
+
+    reader = PipelineStage('ctg-read', read_sources, read_queue)
+    renderer = PipelineStage('ctg-render', render_sources, write_queue)
+    writer = PipelineStage('ctg-write', write_outputs, done_queue)
+    for stage in (reader, renderer, writer):
+        stage.start()
+
+    while True:
+        result = done_queue.get()
+        if result is _END:
+            break
+        yield result
+
+    writer.join()
+    if writer.error:
+        raise writer.error
+
+
+def get_encoded_byte_count(result):
+    return sum(len(encoded_bytes) for _, _, encoded_bytes in result.encoded_outputs)
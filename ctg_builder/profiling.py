@@ -0,0 +1,119 @@
+from contextlib import contextmanager
+import csv
+import json
+import math
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+class RenderProfile:
+    """Stage timings and I/O counters collected while rendering one source."""
+
+    def __init__(self):
+        self.stage_timings = []
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.encoded_bytes_by_format = {}
+        self.peak_rss_bytes = None
+
+    @contextmanager
+    def stage(self, stage_name, img_name=None):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_timings.append(
+                (stage_name, img_name, time.perf_counter() - start_time))
+
+    def add_encoded_bytes(self, format_name, byte_count):
+        self.encoded_bytes_by_format[format_name] = \
+            self.encoded_bytes_by_format.get(format_name, 0) + byte_count
+
+    def record_peak_rss(self):
+        self.peak_rss_bytes = get_peak_rss_bytes()
+
+
+class BuildProfiler:
+    """Collects the RenderProfile of every rendered source and summarises
+    them into a report.
+    """
+
+    def __init__(self):
+        self.images = []
+
+    def add(self, src_filepath, render_profile):
+        self.images.append((src_filepath, render_profile))
+
+    def get_stage_summaries(self):
+        durations_by_stage = {}
+        for _, render_profile in self.images:
+            for stage_name, img_name, duration in render_profile.stage_timings:
+                # Summarise each stage overall and per output instance
+                durations_by_stage.setdefault((stage_name, None), []).append(duration)
+                if img_name is not None:
+                    durations_by_stage.setdefault(
+                        (stage_name, img_name), []).append(duration)
+
+        stage_summaries = []
+        for (stage_name, img_name), durations in sorted(
+                durations_by_stage.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+            durations.sort()
+            stage_summaries.append({
+                'stage': stage_name,
+                'instance': img_name,
+                'count': len(durations),
+                'total_s': sum(durations),
+                'p50_s': get_percentile(durations, 50),
+                'p95_s': get_percentile(durations, 95),
+                'max_s': durations[-1]
+            })
+        return stage_summaries
+
+    def get_report(self):
+        return {
+            'stages': self.get_stage_summaries(),
+            'images': [{
+                'src_filepath': src_filepath,
+                'bytes_read': render_profile.bytes_read,
+                'bytes_written': render_profile.bytes_written,
+                'encoded_bytes_by_format': render_profile.encoded_bytes_by_format,
+                'peak_rss_bytes': render_profile.peak_rss_bytes
+            } for src_filepath, render_profile in self.images]
+        }
+
+    def save(self, filepath):
+        """Write the report as JSON, or the stage summaries as CSV when
+        filepath ends in .csv.
+        """
+        if filepath.lower().endswith('.csv'):
+            fieldnames = ['stage', 'instance', 'count', 'total_s', 'p50_s', 'p95_s', 'max_s']
+            with open(filepath, 'w', newline='') as report_file:
+                writer = csv.DictWriter(report_file, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(self.get_stage_summaries())
+        else:
+            with open(filepath, 'w') as report_file:
+                json.dump(self.get_report(), report_file, indent=1)
+
+
+def get_percentile(sorted_values, percentile):
+    """Nearest-rank percentile of an already sorted list."""
+    rank = max(1, int(math.ceil(percentile / 100 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def get_peak_rss_bytes():
+    if resource is None:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak_rss
+    return peak_rss * 1024
@@ -0,0 +1,524 @@
+from PIL import Image, ImageFile
+import io
+import os
+from ctg_builder import utils
+from ctg_builder.encoding import get_encoder_profiles
+from ctg_builder.image_algorithm import get_proxy_image, get_factor_error
+from ctg_builder.models import RenderJob
+from ctg_builder.profiling import RenderProfile
+from ctg_builder.watermark import add_watermark_to_image, DEFAULT_FONT_FILEPATH
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+# Most pixels of a source held at once while it is decoded in strips
+BOUNDED_STRIP_PIXELS = 4 * 1024 * 1024
+
+# Modes that Image.reduce supports
+REDUCIBLE_MODES = ('L', 'RGB', 'RGBA', 'CMYK')
+
+# Scales the JPEG decoder can decode at
+JPEG_DRAFT_SCALES = (1, 2, 4, 8)
+
+# Let Pillow shrink by an integer factor before the final resample when
+# downscaling by more than this ratio
+RESIZE_REDUCING_GAP = 3.0
+
+# Largest relative aspect ratio difference between two output instances for
+# the smaller one to be cascaded from the larger one
+CASCADE_ASPECT_RATIO_TOLERANCE = 0.01
+
+
+class SourceTooLargeError(Exception):
+    pass
+
+
+class ParkImageRenderResult:
+
+    def __init__(self, render_job):
+        self.render_job = render_job
+        self.src_filepath = render_job.park_image_model.src_filepath
+        self.rendered_instances = []
+        self.allocated_bytes = 0
+        self.proxy_factor_errors = []
+        self.cascade_psnrs = []
+        self.encoded_outputs = []
+        self.bounded_decode = None
+        self.profile = RenderProfile()
+        self.error = None
+
+
+def open_source_image(src, img_output_instances, max_pixels=None):
+    """Open and decode a source image (a path or file object) once for all
+    of its output instances.
+
+    JPEG sources are decoded at the smallest DCT scale that still covers the
+    largest fill size of any output instance.
+
+    Sources over max_pixels take a memory-bounded path, where they are
+    decoded at a reduced scale without ever holding the full resolution
+    image. Without max_pixels, every source is decoded in full, up to
+    Pillow's decompression bomb limit. Returns the image and a description
+    of the bounded decode, or None if the source was decoded normally.
+    """
+    img = utils.open_image_lazily(src, max_pixels)
+
+    draft_width = 0
+    draft_height = 0
+    for instance_settings in img_output_instances:
+        fill_width, fill_height = utils.get_fill_size(
+            img.width, img.height,
+            instance_settings.img_width, instance_settings.img_height)
+        draft_width = max(draft_width, fill_width)
+        draft_height = max(draft_height, fill_height)
+
+    if max_pixels and img.width * img.height > max_pixels:
+        return open_bounded_source_image(img, draft_width, draft_height, max_pixels)
+
+    if draft_width > 0 and draft_height > 0:
+        img.draft(img.mode, (draft_width, draft_height))
+
+    img.load()
+    return img, None
+
+
+def open_bounded_source_image(img, draft_width, draft_height, max_pixels):
+    """Decode a lazily opened source that is over max_pixels at the largest
+    integer scale that fits max_pixels, or smaller if that still covers
+    the draft size.
+    """
+    width, height = img.size
+    fill_scale = 1
+    if draft_width > 0 and draft_height > 0:
+        fill_scale = max(1, min(width // draft_width, height // draft_height))
+
+    if img.format == 'JPEG' and len(img.tile) == 1:
+        # Pick the DCT scale draft would pick for the fill size unless it
+        # leaves the image over budget
+        scales = [scale for scale in JPEG_DRAFT_SCALES
+                  if get_reduced_pixel_count(width, height, scale) <= max_pixels]
+        if not scales:
+            raise SourceTooLargeError(
+                str(width) + 'x' + str(height) + ' is over the source pixel budget '
+                'even at the smallest JPEG decoding scale')
+        scale = max(scales[0], max(
+            scale for scale in JPEG_DRAFT_SCALES if scale <= fill_scale))
+        img.draft(img.mode, (max(1, width // scale), max(1, height // scale)))
+        img.load()
+        return img, 'JPEG draft at 1/' + str(scale)
+
+    # PNG and compressed TIFF are single compressed streams that Pillow can
+    # only decode as a whole
+    strips = get_raw_strips(img)
+    if strips is None:
+        raise SourceTooLargeError(
+            str(width) + 'x' + str(height) + ' is over the source pixel budget and ' +
+            str(img.format) + ' ' + img.mode + ' images cannot be decoded in strips, '
+            'raise or unset ImageProcessing.max_source_pixels to decode it at full size')
+
+    scale = fill_scale
+    while get_reduced_pixel_count(width, height, scale) > max_pixels:
+        scale += 1
+    reduced_img = load_reduced_strips(img, strips, scale)
+    img.close()
+    return reduced_img, 'strips at 1/' + str(scale)
+
+
+def get_reduced_pixel_count(width, height, scale):
+    return ((width + scale - 1) // scale) * ((height + scale - 1) // scale)
+
+
+def get_raw_strips(img):
+    """Get the uncompressed, full width strips that make up a lazily opened
+    image as (offset, y0, y1, rawmode, stride, orientation), or None if it
+    cannot be read strip by strip.
+    """
+    if img.mode not in REDUCIBLE_MODES:
+        return None
+
+    strips = []
+    for codec_name, extents, offset, args in sorted(img.tile, key=lambda tile: tile[1][1]):
+        x0, y0, x1, y1 = extents
+        if codec_name != 'raw' or x0 != 0 or x1 != img.width:
+            return None
+
+        if isinstance(args, str):
+            args = (args,)
+        rawmode = args[0]
+        stride = args[1] if len(args) > 1 else 0
+        orientation = args[2] if len(args) > 2 else 1
+        if stride == 0:
+            # Rows are packed, measure the size of one in rawmode
+            try:
+                stride = len(Image.new(img.mode, (img.width, 1)).tobytes('raw', rawmode))
+            except ValueError:
+                return None
+        if stride < 0:
+            return None
+
+        strips.append((offset, y0, y1, rawmode, stride, orientation))
+
+    # Strips have to cover the image without gaps
+    expected_y = 0
+    for _, y0, y1, _, _, _ in strips:
+        if y0 != expected_y:
+            return None
+        expected_y = y1
+    if expected_y != img.height:
+        return None
+
+    return strips
+
+
+def load_reduced_strips(img, strips, scale):
+    """Decode img a few rows at a time and shrink each chunk of rows by scale
+    as soon as it is complete, so only the reduced image and one chunk of
+    full resolution rows are ever held in memory.
+    """
+    width, height = img.size
+    reduced_img = Image.new(img.mode, ((width + scale - 1) // scale, (height + scale - 1) // scale))
+    reduced_img.info = img.info.copy()
+
+    # A multiple of scale, so every chunk reduces to whole output rows
+    chunk_rows = scale * max(1, BOUNDED_STRIP_PIXELS // (width * scale))
+    chunk = Image.new(img.mode, (width, chunk_rows))
+    chunk_y = 0
+    reduced_y = 0
+
+    for offset, y0, y1, rawmode, stride, orientation in strips:
+        y = y0
+        while y < y1:
+            band_rows = min(y1 - y, chunk_rows - chunk_y)
+            # Bottom-up strips store their last row first
+            if orientation < 0:
+                band_offset = offset + (y1 - y - band_rows) * stride
+            else:
+                band_offset = offset + (y - y0) * stride
+            img.fp.seek(band_offset)
+            band_bytes = img.fp.read(band_rows * stride)
+            # Pad truncated sources, as LOAD_TRUNCATED_IMAGES does
+            band_bytes += bytes(band_rows * stride - len(band_bytes))
+
+            band = Image.frombuffer(
+                img.mode, (width, band_rows), band_bytes, 'raw', rawmode, stride, orientation)
+            chunk.paste(band, (0, chunk_y))
+            chunk_y += band_rows
+            y += band_rows
+
+            if chunk_y == chunk_rows:
+                reduced_img.paste(chunk.reduce(scale), (0, reduced_y))
+                reduced_y += chunk_rows // scale
+                chunk_y = 0
+
+    if chunk_y > 0:
+        reduced_img.paste(chunk.crop((0, 0, width, chunk_y)).reduce(scale), (0, reduced_y))
+
+    return reduced_img
+
+
+def enhance_image(img, instance_settings, enhancement_factors=None):
+    """Enhance img with the enhancement engine selected for the instance."""
+    enhancement_algorithm_list = instance_settings.enhancement_algorithm_list
+    enhancement_engine = getattr(instance_settings, 'enhancement_engine', 'pil')
+
+    if enhancement_engine == 'numpy':
+        # Imported here so numpy is only required when the engine is used
+        from ctg_builder import image_algorithm_numpy
+        return image_algorithm_numpy.enhance(
+            img, enhancement_algorithm_list, enhancement_factors)
+
+    return enhancement_algorithm_list.enhance(img, enhancement_factors)
+
+
+def resize_and_enhance_image(img, instance_settings, enhancement_factors=None, profile=None, img_name=None, enhance=True):
+    """Resize img to fill one output instance and, if enhance is set,
+    apply its enhancements.
+
+    Returns the result image and the number of bytes allocated by the
+    geometry stage.
+    """
+    profile = profile or RenderProfile()
+
+    with profile.stage('geometry', img_name):
+        result_img, allocated_bytes = utils.resize_fill_canvas_image(
+            img, instance_settings.img_width, instance_settings.img_height,
+            Image.BICUBIC, reducing_gap=RESIZE_REDUCING_GAP)
+
+    if enhance:
+        with profile.stage('enhance', img_name):
+            result_img = enhance_image(result_img, instance_settings, enhancement_factors)
+
+    return result_img, allocated_bytes
+
+
+def watermark_image(img, instance_settings, img_settings, profile=None, img_name=None):
+    """Watermark img in place for one output instance."""
+    profile = profile or RenderProfile()
+
+    with profile.stage('watermark', img_name):
+        return add_watermark_to_image(
+            img, img_settings.Watermark.text,
+            img_settings.Watermark.rgb, instance_settings.watermark_font_size,
+            getattr(img_settings.Watermark, 'font_filepath', DEFAULT_FONT_FILEPATH))
+
+
+def render_image_instance(img, instance_settings, img_settings, enhancement_factors=None, profile=None, img_name=None):
+    """Resize, enhance and watermark a decoded source for one output instance.
+
+    enhancement_factors are passed on to the enhancement list, which measures
+    the resized image itself when they are not given. Stage timings are
+    recorded on profile under img_name.
+    Returns the result image and the number of bytes allocated by the
+    geometry stage.
+    """
+    result_img, allocated_bytes = resize_and_enhance_image(
+        img, instance_settings, enhancement_factors, profile, img_name)
+    result_img = watermark_image(
+        result_img, instance_settings, img_settings, profile, img_name)
+
+    return result_img, allocated_bytes
+
+
+class CascadeLevel:
+    """An already rendered output instance that smaller instances with the
+    same aspect ratio can be resized from instead of the full source.
+    """
+
+    def __init__(self, instance_settings, geometry_img, enhanced_img):
+        self.instance_settings = instance_settings
+        self.geometry_img = geometry_img
+        self.enhanced_img = enhanced_img
+
+    def can_render(self, instance_settings):
+        width = self.instance_settings.img_width
+        height = self.instance_settings.img_height
+        if instance_settings.img_width > width or instance_settings.img_height > height:
+            return False
+
+        # Deriving an instance with a different aspect ratio would crop the
+        # already cropped level and lose part of the frame
+        ratio = width / height
+        new_ratio = instance_settings.img_width / instance_settings.img_height
+        return abs(ratio - new_ratio) / ratio <= CASCADE_ASPECT_RATIO_TOLERANCE
+
+    def can_reuse_enhancement(self, instance_settings):
+        """Whether instance_settings is resized from the enhanced image of
+        this level rather than enhanced again.
+        """
+        return self.can_render(instance_settings) and \
+            self.instance_settings.enhancement_algorithm_list is \
+            instance_settings.enhancement_algorithm_list
+
+
+def get_cascade_order(dest_instances, img_settings):
+    """Sort dest_instances largest first, so each can be resized from the
+    one before it.
+    """
+    def get_area(dest_instance):
+        instance_settings = img_settings.output_instances[dest_instance.img_name]
+        return instance_settings.img_width * instance_settings.img_height
+
+    return sorted(dest_instances, key=get_area, reverse=True)
+
+
+def render_cascade_level(img, cascade_level, instance_settings, img_settings, enhancement_factors, profile, img_name):
+    """Render one instance, from cascade_level if it can be used and from the
+    full source img otherwise.
+
+    Returns the unenhanced geometry image and the enhanced image of the new
+    level and the number of bytes allocated.
+    """
+    if cascade_level is None or not cascade_level.can_render(instance_settings):
+        geometry_img, allocated_bytes = resize_and_enhance_image(
+            img, instance_settings, profile=profile, img_name=img_name, enhance=False)
+        enhanced_img = geometry_img
+        with profile.stage('enhance', img_name):
+            enhanced_img = enhance_image(geometry_img, instance_settings, enhancement_factors)
+        return geometry_img, enhanced_img, allocated_bytes
+
+    # Reuse the parent's enhancement when the enhancement list is the same,
+    # otherwise enhance the resized, unenhanced parent
+    if cascade_level.can_reuse_enhancement(instance_settings):
+        enhanced_img, allocated_bytes = resize_and_enhance_image(
+            cascade_level.enhanced_img, instance_settings, profile=profile,
+            img_name=img_name, enhance=False)
+        # Levels further down with another enhancement list resize the
+        # parent's unenhanced image rather than enhancing this one again
+        return cascade_level.geometry_img, enhanced_img, allocated_bytes
+
+    geometry_img, allocated_bytes = resize_and_enhance_image(
+        cascade_level.geometry_img, instance_settings, profile=profile,
+        img_name=img_name, enhance=False)
+    with profile.stage('enhance', img_name):
+        enhanced_img = enhance_image(geometry_img, instance_settings, enhancement_factors)
+    return geometry_img, enhanced_img, allocated_bytes
+
+
+def get_proxy_box(proxy_img, img, instance_settings):
+    """Get the box of proxy_img, a downscaled copy of img, that shows the
+    part of img visible in one output instance, as the instance's statistics
+    are taken after the fill crop.
+    """
+    x0, y0, x1, y1 = utils.get_fill_canvas_box(
+        img.width, img.height, instance_settings.img_width, instance_settings.img_height)
+    scale_x = proxy_img.width / img.width
+    scale_y = proxy_img.height / img.height
+    return (
+        max(0, round(x0 * scale_x)),
+        max(0, round(y0 * scale_y)),
+        min(proxy_img.width, round(x1 * scale_x)),
+        min(proxy_img.height, round(y1 * scale_y))
+    )
+
+
+def get_proxy_factor_error(img, instance_settings, proxy_factors):
+    """Get the relative error of proxy_factors against the factors measured
+    on the full resolution resized image.
+    """
+    full_img, _ = utils.resize_fill_canvas_image(
+        img, instance_settings.img_width, instance_settings.img_height,
+        Image.BICUBIC, reducing_gap=RESIZE_REDUCING_GAP)
+    full_factors = instance_settings.enhancement_algorithm_list.determine_factors(
+        full_img)
+
+    return get_factor_error(proxy_factors, full_factors)
+
+
+def render_park_image(render_job, img_settings, src_bytes=None):
+    """Render and save the destination instances of one park image listed in
+    render_job.
+
+    If src_bytes is given, the source is decoded from it instead of being
+    read from disk, and the encoded outputs are returned on the result as
+    (dest_instance, dest_filepath, bytes) triples for the caller to write.
+    The source is decoded at most once, however many instances it has.
+    Errors are caught and recorded on the returned result so that a single
+    corrupt source does not abort the rest of the run.
+    """
+    result = ParkImageRenderResult(render_job)
+    profile = result.profile
+
+    try:
+        with profile.stage('decode'):
+            src = render_job.park_image_model.src_filepath
+            if src_bytes is not None:
+                src = io.BytesIO(src_bytes)
+            # Size the decode for every output instance, not only the pending
+            # ones, so an instance rebuilt on its own gets the same bytes as in
+            # a full build
+            img, result.bounded_decode = open_source_image(
+                src, img_settings.output_instances.values(),
+                getattr(img_settings, 'max_source_pixels', None))
+        profile.bytes_read += render_job.source_key.size
+
+        # Measure enhancement statistics once per source on a small proxy
+        # and share the factors across instances with the same enhancement
+        # list and visible part of the source
+        proxy_stats_size = getattr(img_settings, 'proxy_stats_size', None)
+        proxy_img = None
+        proxy_factors = {}
+        if proxy_stats_size:
+            with profile.stage('proxy'):
+                proxy_img = get_proxy_image(img, proxy_stats_size)
+
+        # In cascade mode only the largest instance is resized from the full
+        # source and each smaller one from the level rendered before it
+        cascade_rendering = getattr(img_settings, 'cascade_rendering', False)
+        cascade_watermark = getattr(img_settings, 'cascade_watermark', 'last')
+        cascade_level = None
+        dest_instances = render_job.dest_instances
+        pending_img_names = set(dest_instance.img_name for dest_instance in dest_instances)
+        if cascade_rendering:
+            # Build the levels above pending ones too, so an instance rebuilt
+            # on its own is resized from the same parents as in a full build
+            dest_instances = get_cascade_order(
+                render_job.park_image_model.dest_instances, img_settings)
+            while dest_instances[-1].img_name not in pending_img_names:
+                dest_instances.pop()
+
+        for dest_instance in dest_instances:
+            # Process and save image instance (resize, apply enhancements, add watermark, etc.)
+            instance_settings = img_settings.output_instances[
+                dest_instance.img_name]
+            is_pending = dest_instance.img_name in pending_img_names
+            enhancement_algorithm_list = instance_settings.enhancement_algorithm_list
+
+            enhancement_factors = None
+            if proxy_img is not None:
+                proxy_box = get_proxy_box(proxy_img, img, instance_settings)
+                proxy_key = (id(enhancement_algorithm_list), proxy_box)
+                if proxy_key not in proxy_factors:
+                    with profile.stage('proxy'):
+                        proxy_factors[proxy_key] = enhancement_algorithm_list.determine_factors(
+                            proxy_img.crop(proxy_box))
+                enhancement_factors = proxy_factors[proxy_key]
+
+            if cascade_rendering:
+                # With the watermark applied per level, it is drawn into the
+                # level and carried down to the levels resized from it, which
+                # are not watermarked again. Otherwise levels are passed down
+                # unwatermarked and each output is watermarked last.
+                inherits_watermark = cascade_watermark == 'per_level' and \
+                    cascade_level is not None and \
+                    cascade_level.can_reuse_enhancement(instance_settings)
+
+                geometry_img, enhanced_img, allocated_bytes = render_cascade_level(
+                    img, cascade_level, instance_settings, img_settings,
+                    enhancement_factors, profile, dest_instance.img_name)
+                result.allocated_bytes += allocated_bytes
+
+                result_img = enhanced_img
+                if not inherits_watermark and (is_pending or cascade_watermark == 'per_level'):
+                    result_img = watermark_image(
+                        enhanced_img.copy(), instance_settings, img_settings,
+                        profile, dest_instance.img_name)
+                if cascade_watermark == 'per_level':
+                    enhanced_img = result_img
+                cascade_level = CascadeLevel(instance_settings, geometry_img, enhanced_img)
+
+                if not is_pending:
+                    continue
+
+                if getattr(img_settings, 'cascade_check', False):
+                    independent_img, _ = render_image_instance(
+                        img, instance_settings, img_settings, enhancement_factors)
+                    result.cascade_psnrs.append(
+                        (dest_instance.img_name, utils.get_psnr(result_img, independent_img)))
+            else:
+                result_img, allocated_bytes = render_image_instance(
+                    img, instance_settings, img_settings, enhancement_factors,
+                    profile, dest_instance.img_name)
+                result.allocated_bytes += allocated_bytes
+
+            if enhancement_factors and getattr(img_settings, 'proxy_stats_check', False):
+                result.proxy_factor_errors.append(get_proxy_factor_error(
+                    img, instance_settings, enhancement_factors))
+
+            encoder_profiles = get_encoder_profiles(instance_settings)
+            if src_bytes is None:
+                # Create result directory if it doesn't exist
+                os.makedirs(os.path.dirname(dest_instance.filepath), exist_ok=True)
+
+            for encoder_profile, dest_filepath in zip(encoder_profiles, dest_instance.filepaths):
+                save_params = encoder_profile.get_save_params(img_settings)
+                with profile.stage('encode-' + encoder_profile.name, dest_instance.img_name):
+                    if src_bytes is not None:
+                        output = io.BytesIO()
+                        result_img.save(output, encoder_profile.format, **save_params)
+                    else:
+                        result_img.save(dest_filepath, encoder_profile.format, **save_params)
+                if src_bytes is not None:
+                    encoded_bytes = output.getvalue()
+                    result.encoded_outputs.append((dest_instance, dest_filepath, encoded_bytes))
+                    profile.add_encoded_bytes(encoder_profile.name, len(encoded_bytes))
+                else:
+                    byte_count = os.path.getsize(dest_filepath)
+                    profile.bytes_written += byte_count
+                    profile.add_encoded_bytes(encoder_profile.name, byte_count)
+
+            result.rendered_instances.append(dest_instance)
+    except Exception as e:
+        result.error = type(e).__name__ + ': ' + str(e)
+
+    profile.record_peak_rss()
+
+    return result
@@ -0,0 +1,21 @@
+def get_render_cost(render_job):
+    """Estimate the work of a render job from the header of its source.
+
+    Decoding scales with the source's pixel count and file size, and every
+    pending output instance resizes and encodes the decoded image again.
+    """
+    pixel_count = render_job.park_image_model.pixel_count or 0
+    return pixel_count * (1 + len(render_job.dest_instances)) + render_job.source_key.size
+
+
+def order_largest_first(render_jobs):
+    """Get render_jobs sorted from the most to the least costly.
+
+    A parallel run otherwise ends with a few workers rendering the largest
+    sources while the rest sit idle. Sorting needs every job to be planned
+    first, which only reads source headers and cached metadata. Jobs of equal
+    cost keep their discovery order.
+    """
+    render_jobs = list(render_jobs)
+    render_jobs.sort(key=get_render_cost, reverse=True)
+    return render_jobs
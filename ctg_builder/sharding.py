@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+
+SHARD_BY_PARK = 'park'
+SHARD_BY_HASH = 'hash'
+SHARD_KEYS = (SHARD_BY_PARK, SHARD_BY_HASH)
+
+PARTIAL_VERSION = 1
+
+
+class Shard:
+    """One of shard_count deterministic partitions of the source tree.
+
+    Sources are assigned by park name, or by the start_rel_path hash that
+    also prefixes their destination filenames, so the assignment only
+    depends on source paths and every node computes the same partition
+    without reading any image.
+    """
+
+    def __init__(self, shard_index, shard_count, shard_by=SHARD_BY_PARK):
+        if shard_by not in SHARD_KEYS:
+            raise ValueError('Unknown shard key ' + shard_by)
+        if not 0 <= shard_index < shard_count:
+            raise ValueError('Shard index ' + str(shard_index) +
+                             ' is not in 0..' + str(shard_count - 1))
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.shard_by = shard_by
+
+        # Position of each selected source in the discovery order of the
+        # whole tree, which the merge uses to restore single-node order
+        self.ordinals = {}
+
+    @property
+    def name(self):
+        return 'shard-' + str(self.shard_index) + '-of-' + str(self.shard_count)
+
+    def get_filename(self, filename):
+        """Get a per-shard variant of a state filename, e.g. for the build
+        manifest, so shards sharing a destination never write the same file.
+        """
+        base_name, ext = os.path.splitext(filename)
+        return base_name + '.' + self.name + ext
+
+    def contains(self, src_filepath, src_dirpath):
+        return get_shard_index(
+            src_filepath, src_dirpath, self.shard_count, self.shard_by) == self.shard_index
+
+    def select(self, src_filepaths, src_dirpath):
+        """Yield the sources of src_filepaths that belong to this shard."""
+        for ordinal, src_filepath in enumerate(src_filepaths):
+            if self.contains(src_filepath, src_dirpath):
+                self.ordinals[src_filepath] = ordinal
+                yield src_filepath
+
+    def save_partial(self, filepath, catalog):
+        """Write the catalog of this shard's images for the merge step."""
+        images = []
+        for i in range(len(catalog)):
+            record = catalog.get_record(i)
+            images.append([self.ordinals[record[0]]] + list(record))
+
+        partial = {
+            'version': PARTIAL_VERSION,
+            'shard_index': self.shard_index,
+            'shard_count': self.shard_count,
+            'shard_by': self.shard_by,
+            'images': images
+        }
+        tmp_filepath = filepath + '.tmp'
+        with open(tmp_filepath, 'w') as partial_file:
+            json.dump(partial, partial_file)
+        os.replace(tmp_filepath, filepath)
+
+
+def get_shard_index(src_filepath, src_dirpath, shard_count, shard_by=SHARD_BY_PARK):
+    # Imported here so the CLI can read the shard keys without loading PIL
+    from ctg_builder.models import get_park_name, get_start_rel_path, get_start_rel_path_hash
+
+    start_rel_path = get_start_rel_path(src_filepath, src_dirpath)
+    if shard_by == SHARD_BY_HASH:
+        shard_key = get_start_rel_path_hash(start_rel_path)
+    else:
+        # Use a stable hash rather than hash(), which is salted per process
+        shard_key = hashlib.md5(
+            get_park_name(start_rel_path).encode('utf-8')).hexdigest()
+    return int(shard_key, 16) % shard_count
+
+
+def merge_partials(partial_filepaths, catalog):
+    """Load the partial results of every shard of a build into catalog, in
+    the order a single-node build would have discovered them.
+
+    Raises ValueError unless the partials are exactly one of each shard of
+    the same partition.
+    """
+    partials = []
+    for partial_filepath in partial_filepaths:
+        with open(partial_filepath) as partial_file:
+            partial = json.load(partial_file)
+        if partial.get('version') != PARTIAL_VERSION:
+            raise ValueError(partial_filepath + ' is not a partial build result')
+        partials.append(partial)
+
+    if not partials:
+        raise ValueError('No partial build results to merge')
+
+    shard_count = partials[0]['shard_count']
+    shard_by = partials[0]['shard_by']
+    for partial in partials:
+        if partial['shard_count'] != shard_count or partial['shard_by'] != shard_by:
+            raise ValueError('Partial build results come from different partitions')
+
+    shard_indices = sorted(partial['shard_index'] for partial in partials)
+    if shard_indices != list(range(shard_count)):
+        raise ValueError('Expected one partial build result for each of ' +
+                         str(shard_count) + ' shards, got shards ' +
+                         ', '.join(str(i) for i in shard_indices))
+
+    images = []
+    for partial in partials:
+        images.extend(partial['images'])
+    images.sort(key=lambda image: image[0])
+
+    for image in images:
+        catalog.append_record(*image[1:])
@@ -1,10 +1,26 @@
 import re
-from PIL import Image
+from PIL import Image, ImageChops, ImageStat
 import os
 from datetime import datetime
 import json
 import math
 
+IMAGE_EXTENSIONS = {
+    '.jpg', '.jpeg', '.jpe', '.png', '.tif', '.tiff', '.webp', '.bmp', '.gif',
+    '.ppm', '.tga'}
+
+# Leading bytes of the image formats in IMAGE_EXTENSIONS that have a
+# distinct signature, used for files without a known extension
+IMAGE_MAGIC_BYTES = [
+    b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'II*\x00', b'MM\x00*', b'GIF8', b'BM']
+
+EXIF_IFD_TAG = 0x8769
+EXIF_DATE_TIME_ORIGINAL_TAG = 36867
+
+# Start of frame markers, whose segment holds the image size. DHT, JPG and
+# DAC share their range of marker codes.
+JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
 
 # Sourced from http://stackoverflow.com/a/27058505
 class DateTimeEncoder(json.JSONEncoder):
@@ -24,18 +40,123 @@ def get_date_modified(filename):
 
 # Partially sourced from http://stackoverflow.com/a/23064792
 def get_date_photo_taken(filepath):
-    img = Image.open(filepath)
-    if not img:
+    # getexif works for every format, unlike the JPEG-only _getexif
+    with Image.open(filepath) as img:
+        return get_exif_date_photo_taken(img.getexif())
+
+
+def get_exif_date_photo_taken(exif):
+    """Get the capture date of a loaded Image.Exif, or None.
+
+    DateTimeOriginal belongs in the Exif sub-IFD, but some writers store it
+    in IFD0, where _getexif also found it.
+    """
+    exif_str_val = exif.get_ifd(EXIF_IFD_TAG).get(EXIF_DATE_TIME_ORIGINAL_TAG)
+    if exif_str_val is None:
+        exif_str_val = exif.get(EXIF_DATE_TIME_ORIGINAL_TAG)
+    return parse_exif_date(exif_str_val)
+
+
+def parse_exif_date(exif_str_val):
+    """Get the datetime of an EXIF date string, or None if it is missing or
+    malformed.
+    """
+    if not isinstance(exif_str_val, str):
         return None
 
-    exif = img._getexif()
-    if not exif:
+    try:
+        return datetime.strptime(exif_str_val.strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except ValueError:
         return None
 
-    exif_str_val = exif[36867]
 
-    exif_datetime_val = datetime.strptime(exif_str_val, '%Y:%m:%d %H:%M:%S')
-    return exif_datetime_val
+def open_image_lazily(src, max_pixels=None):
+    """Open an image without decoding it.
+
+    A source pixel budget (max_pixels) replaces Pillow's decompression bomb
+    limit, which would refuse sources that the budget lets through at
+    reduced size.
+    """
+    if max_pixels:
+        Image.MAX_IMAGE_PIXELS = None
+    return Image.open(src)
+
+
+def read_header_metadata(filepath, max_pixels=None):
+    """Get the EXIF capture date and the pixel count of an image in one pass
+    over its header.
+
+    JPEGs are only read up to the frame header that holds their size, which
+    follows the Exif APP1 segment. Other formats are opened lazily with
+    Pillow, see open_image_lazily for max_pixels. The pixel count is 0 if a
+    JPEG ends before its frame header.
+    """
+    with open(filepath, 'rb') as f:
+        jpeg_header = read_jpeg_header(f)
+
+    if jpeg_header is None:
+        with open_image_lazily(filepath, max_pixels) as img:
+            return get_exif_date_photo_taken(img.getexif()), img.width * img.height
+
+    exif_data, pixel_count = jpeg_header
+    if not exif_data:
+        return None, pixel_count
+
+    exif = Image.Exif()
+    exif.load(exif_data)
+    return get_exif_date_photo_taken(exif), pixel_count
+
+
+def read_jpeg_header(f):
+    """Read the Exif APP1 segment and the pixel count of the frame header
+    from an open JPEG file.
+
+    Returns None if the file is not a JPEG. The Exif segment is empty if the
+    JPEG has no EXIF data, and the pixel count is 0 if the file has no
+    frame header before its pixel data.
+    """
+    if f.read(2) != b'\xff\xd8':
+        return None
+
+    exif_data = b''
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return exif_data, 0
+
+        # Fill bytes may pad the space before a marker
+        if marker[1] == 0xff:
+            f.seek(-1, os.SEEK_CUR)
+            continue
+
+        # Pixel data starts at SOS, so no metadata segments follow it
+        if marker[1] == 0xda:
+            return exif_data, 0
+
+        # Standalone markers have no length field
+        if marker[1] == 0x01 or 0xd0 <= marker[1] <= 0xd8:
+            continue
+
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return exif_data, 0
+        length = int.from_bytes(length_bytes, 'big') - 2
+
+        if marker[1] in JPEG_SOF_MARKERS:
+            # Sample precision, then the height and width
+            frame_header = f.read(5)
+            if len(frame_header) < 5:
+                return exif_data, 0
+            height = int.from_bytes(frame_header[1:3], 'big')
+            width = int.from_bytes(frame_header[3:5], 'big')
+            return exif_data, width * height
+
+        if marker[1] == 0xe1 and not exif_data:
+            segment = f.read(length)
+            if segment.startswith(b'Exif\x00\x00'):
+                exif_data = segment
+        else:
+            f.seek(length, os.SEEK_CUR)
 
 
 def get_full_filepaths_in_tree(root_dir_path):
@@ -47,6 +168,56 @@ def get_full_filepaths_in_tree(root_dir_path):
     return filepaths
 
 
+def iter_image_filepaths_in_tree(root_dir_path):
+    """Yield the paths of image files under root_dir_path as they are found.
+
+    Directories are walked in sorted order, each directory's files before
+    its subdirectories, so the order is stable between runs. Hidden files
+    and directories, sidecars and RAW files are skipped.
+    """
+    dirpaths = [root_dir_path]
+    while dirpaths:
+        dirpath = dirpaths.pop()
+
+        with os.scandir(dirpath) as dir_entries:
+            entries = sorted(dir_entries, key=lambda entry: entry.name)
+
+        subdirpaths = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            # Not following directory symlinks, which could form a cycle
+            if entry.is_dir(follow_symlinks=False):
+                subdirpaths.append(entry.path)
+            elif entry.is_file() and is_image_file(entry.path):
+                yield entry.path
+
+        # Reversed so the stack pops subdirectories in sorted order
+        dirpaths.extend(reversed(subdirpaths))
+
+
+def is_image_file(filepath):
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        return True
+    if extension:
+        return False
+
+    # Fall back to sniffing files that have no extension at all
+    with open(filepath, 'rb') as f:
+        header = f.read(16)
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return True
+    return any(header.startswith(magic_bytes) for magic_bytes in IMAGE_MAGIC_BYTES)
+
+
+def iter_and_collect(iterable, collected):
+    """Yield the items of iterable, appending each one to collected."""
+    for item in iterable:
+        collected.append(item)
+        yield item
+
+
 def get_numeric_part_from_string(text):
     found_numbers = re.findall(r'\d+', text)
     return (''.join(found_numbers))
@@ -62,12 +233,12 @@ def add_to_filename_without_extension(filepath, addition):
                         addition + filename_ext)
 
 
-def resize_fill_image(img, min_image_width, min_image_height, resample_mode):
-    img_width = img.size[0]
-    img_height = img.size[1]
+def get_fill_size(img_width, img_height, min_image_width, min_image_height):
+    """Get the smallest size with the image's aspect ratio that covers
+    min_image_width x min_image_height.
+    """
     old_ratio = img_width / img_height
     new_ratio = min_image_width / min_image_height
-    print('old_ratio=' + str(old_ratio) + ', new_ratio=' + str(new_ratio))
 
     if old_ratio <= new_ratio:
         new_image_width = min_image_width
@@ -76,11 +247,16 @@ def resize_fill_image(img, min_image_width, min_image_height, resample_mode):
         new_image_height = min_image_height
         new_image_width = new_image_height * old_ratio
 
-    new_image_size = (
+    return (
         int(new_image_width),
         int(new_image_height)
     )
 
+
+def resize_fill_image(img, min_image_width, min_image_height, resample_mode):
+    new_image_size = get_fill_size(
+        img.size[0], img.size[1], min_image_width, min_image_height)
+
     return img.resize(size=new_image_size, resample=resample_mode)
 
 
@@ -109,6 +285,76 @@ def canvas_resize_image(img, canvas_width, canvas_height):
     return newImage
 
 
+def resize_fill_canvas_image(img, canvas_width, canvas_height, resample_mode, reducing_gap=None):
+    """Resize img to fill the canvas and center it in a single resample.
+
+    Gives the same framing as resize_fill_image followed by
+    canvas_resize_image, but only the region that ends up visible on the
+    canvas is resampled and no intermediate image is allocated.
+    Returns the result image and the number of bytes allocated for it.
+    """
+    fill_width, fill_height = get_fill_size(
+        img.width, img.height, canvas_width, canvas_height)
+
+    # Rounding can leave the filled image a pixel short of the canvas, in
+    # which case it needs the background border of the two step path
+    if fill_width < canvas_width or fill_height < canvas_height:
+        fill_img = img.resize(
+            size=(fill_width, fill_height), resample=resample_mode,
+            reducing_gap=reducing_gap)
+        result_img = canvas_resize_image(fill_img, canvas_width, canvas_height)
+        allocated_bytes = get_image_byte_count(fill_img) + \
+            get_image_byte_count(result_img)
+        return result_img, allocated_bytes
+
+    box = get_fill_canvas_box(img.width, img.height, canvas_width, canvas_height)
+    result_img = img.resize(
+        size=(canvas_width, canvas_height), resample=resample_mode, box=box,
+        reducing_gap=reducing_gap)
+    return result_img, get_image_byte_count(result_img)
+
+
+def get_fill_canvas_box(img_width, img_height, canvas_width, canvas_height):
+    """Get the box of an image that is visible on the canvas after
+    resize_fill_canvas_image, in the image's own coordinates.
+    """
+    fill_width, fill_height = get_fill_size(
+        img_width, img_height, canvas_width, canvas_height)
+
+    # The whole image is visible when it falls a pixel short of the canvas
+    if fill_width < canvas_width or fill_height < canvas_height:
+        return (0, 0, img_width, img_height)
+
+    # Offset of the filled image on the canvas, as in canvas_resize_image
+    x1 = int(math.floor((canvas_width - fill_width) / 2))
+    y1 = int(math.floor((canvas_height - fill_height) / 2))
+
+    # Map the visible part of the filled image back to image coordinates
+    scale_x = img_width / fill_width
+    scale_y = img_height / fill_height
+    return (
+        -x1 * scale_x,
+        -y1 * scale_y,
+        (canvas_width - x1) * scale_x,
+        (canvas_height - y1) * scale_y
+    )
+
+
+def get_image_byte_count(img):
+    return img.width * img.height * len(img.getbands())
+
+
+def get_psnr(img_a, img_b):
+    """Get the peak signal-to-noise ratio in dB between two images of the
+    same size and mode. Identical images give infinity.
+    """
+    rms_values = ImageStat.Stat(ImageChops.difference(img_a, img_b)).rms
+    mse = mean([rms ** 2 for rms in rms_values])
+    if mse == 0:
+        return float('inf')
+    return 10 * math.log10(255 ** 2 / mse)
+
+
 # Sourced from http://stackoverflow.com/a/7716358
 def mean(numbers):
     return float(sum(numbers)) / max(len(numbers), 1)
@@ -0,0 +1,46 @@
+import os
+from ctg_builder import utils
+
+
+class SourceTreeChanges:
+
+    def __init__(self, src_filepaths, changed_filepaths, deleted_filepaths):
+        # Every source currently in the tree, in discovery order
+        self.src_filepaths = src_filepaths
+        self.changed_filepaths = changed_filepaths
+        self.deleted_filepaths = deleted_filepaths
+
+    def __bool__(self):
+        return bool(self.changed_filepaths or self.deleted_filepaths)
+
+
+class SourceTreeWatcher:
+    """Detects added, modified and deleted sources by polling the tree.
+
+    Only directory listings and stat results are compared between polls,
+    so an unchanged tree costs no image reads.
+    """
+
+    def __init__(self, root_dir_path):
+        self.root_dir_path = root_dir_path
+        self.stats = {}
+
+    def poll(self):
+        stats = {}
+        for src_filepath in utils.iter_image_filepaths_in_tree(self.root_dir_path):
+            try:
+                stat = os.stat(src_filepath)
+            except OSError:
+                # Deleted since it was listed, it will show up as deleted
+                continue
+            stats[src_filepath] = (stat.st_size, stat.st_mtime_ns)
+
+        changed_filepaths = [
+            src_filepath for src_filepath, src_stat in stats.items()
+            if self.stats.get(src_filepath) != src_stat]
+        deleted_filepaths = [
+            src_filepath for src_filepath in self.stats
+            if src_filepath not in stats]
+
+        self.stats = stats
+        return SourceTreeChanges(list(stats), changed_filepaths, deleted_filepaths)
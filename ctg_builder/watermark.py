@@ -0,0 +1,61 @@
+from PIL import Image, ImageDraw, ImageFont
+import os
+
+DEFAULT_FONT_FILEPATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'fonts', 'arial.ttf')
+
+# Per process caches, so each font file is parsed once and each watermark
+# is only rasterised once
+_fonts = {}
+_watermarks = {}
+
+
+class Watermark:
+    """A pre-rendered watermark: a solid colour layer and its text mask."""
+
+    def __init__(self, mask, fill, offset):
+        self.mask = mask
+        self.fill = fill
+        self.offset = offset
+
+
+def get_font(font_filepath, font_size):
+    key = (font_filepath, font_size)
+    if key not in _fonts:
+        _fonts[key] = ImageFont.truetype(font_filepath, font_size)
+    return _fonts[key]
+
+
+def get_watermark(mode, watermark_text, watermark_rgb, watermark_font_size, font_filepath):
+    key = (mode, watermark_text, tuple(watermark_rgb), watermark_font_size, font_filepath)
+    if key in _watermarks:
+        return _watermarks[key]
+
+    font = get_font(font_filepath, watermark_font_size)
+    left, top, right, bottom = font.getbbox(watermark_text)
+
+    # Rasterise the text once as an alpha mask covering just its bounding box
+    mask = Image.new('L', (max(1, right - left), max(1, bottom - top)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), watermark_text, 255, font=font)
+    fill = Image.new(mode, mask.size, watermark_rgb)
+
+    watermark = Watermark(mask, fill, (left, top))
+    _watermarks[key] = watermark
+    return watermark
+
+
+def add_watermark_to_image(
+        img, watermark_text, watermark_rgb, watermark_font_size,
+        font_filepath=DEFAULT_FONT_FILEPATH):
+    watermark_location = (watermark_font_size,
+                          img.height - watermark_font_size * 2)
+    watermark = get_watermark(
+        img.mode, watermark_text, watermark_rgb, watermark_font_size,
+        font_filepath)
+
+    x = watermark_location[0] + watermark.offset[0]
+    y = watermark_location[1] + watermark.offset[1]
+    img.paste(watermark.fill, (x, y), watermark.mask)
+
+    return img
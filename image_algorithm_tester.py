@@ -1,50 +1,59 @@
-from PIL import Image
+from multiprocessing import Pool
+from PIL import Image, ImageStat
+import argparse
+import csv
+import functools
+import itertools
 import os
+import time
 from ctg_builder import utils, settings
-from ctg_builder.image_algorithm import FactorDeterminer, EnhancementType, EnhancementAlgorithm, EnhancementAlgorithmList
+from ctg_builder.image_algorithm import FactorDeterminer, EnhancementType, EnhancementAlgorithm, EnhancementAlgorithmList, get_brightness, get_saturation
 
 OUTPUT_IMAGE_WIDTH = 1280
 OUTPUT_IMAGE_HEIGHT = 960
 
-#
-# Set up algorithms
-brightness_min_100 = EnhancementAlgorithm(
-    enhancement_type=EnhancementType.Brightness,
-    factor_determiner=FactorDeterminer(min_val=100, avg_count=0))
-saturation_min_30_max_130 = EnhancementAlgorithm(
-    enhancement_type=EnhancementType.Saturation,
-    factor_determiner=FactorDeterminer(min_val=30, max_val=130, avg_count=0))
-saturation_min_30_max_130 = EnhancementAlgorithm(
-    enhancement_type=EnhancementType.Saturation,
-    factor_determiner=FactorDeterminer(min_val=30, max_val=130, avg_count=0))
-autocontrast_normal = EnhancementAlgorithm(
-    enhancement_type=EnhancementType.AutoContrast,
-    factor_determiner=FactorDeterminer())
-autocontrast_cutoff_1percent = EnhancementAlgorithm(
-    enhancement_type=EnhancementType.AutoContrast,
-    factor_determiner=FactorDeterminer(cutoff=0.01))
-
-# Set up algorithm lists
-enhancement_algorithm_lists = [
-    EnhancementAlgorithmList(
-        'Brightness-Min-100',
-        [brightness_min_100]
-    ),
-    EnhancementAlgorithmList(
-        'Saturation-30-to-130_BrightFix',
-        [saturation_min_30_max_130, brightness_min_100]
-    ),
-    EnhancementAlgorithmList(
-        'Saturation-30-to-130_BrightFix-AutoContrast',
-        [saturation_min_30_max_130, brightness_min_100, autocontrast_normal]
-    ),
-    EnhancementAlgorithmList(
-        'Saturation-30-to-130_BrightFix-AutoContrast-Cutoff-1percent',
-        [saturation_min_30_max_130, brightness_min_100, autocontrast_cutoff_1percent]
-    )
-]
-#
-#
+ENHANCEMENT_TYPE_NAMES = {
+    EnhancementType.Brightness: 'brightness',
+    EnhancementType.Saturation: 'saturation',
+    EnhancementType.AutoContrast: 'autocontrast'
+}
+
+METRIC_NAMES = ['brightness', 'saturation', 'contrast', 'clipped_pct', 'psnr_db']
+
+# Default parameter values of each stage of the grid
+DEFAULT_SATURATION_MIN_VALS = [30]
+DEFAULT_SATURATION_MAX_VALS = [110, 130, 150]
+DEFAULT_BRIGHTNESS_MIN_VALS = [90, 100, 110]
+DEFAULT_AUTOCONTRAST_CUTOFFS = [0, 0.01]
+
+
+def expand_algorithms(enhancement_type, **param_ranges):
+    """Get an EnhancementAlgorithm for every combination of the
+    FactorDeterminer parameter values in param_ranges, e.g.
+    expand_algorithms(EnhancementType.Brightness, min_val=[90, 100, 110]).
+    """
+    param_names = sorted(param_ranges)
+    enhancement_algorithms = []
+    for param_values in itertools.product(*(param_ranges[name] for name in param_names)):
+        params = dict(zip(param_names, param_values))
+        enhancement_algorithms.append(EnhancementAlgorithm(
+            enhancement_type=enhancement_type,
+            factor_determiner=FactorDeterminer(**params)))
+    return enhancement_algorithms
+
+
+def get_enhancement_grid(saturation_min_vals, saturation_max_vals, brightness_min_vals, autocontrast_cutoffs):
+    """Set up the grid: each stage lists the algorithms to try at that
+    point of a chain, None meaning the stage is left out.
+    """
+    return [
+        [None] + expand_algorithms(
+            EnhancementType.Saturation, min_val=saturation_min_vals, max_val=saturation_max_vals),
+        expand_algorithms(
+            EnhancementType.Brightness, min_val=brightness_min_vals),
+        [None] + expand_algorithms(
+            EnhancementType.AutoContrast, cutoff=autocontrast_cutoffs)
+    ]
 
 resample_modes = [
     {'name': 'Nearest', 'mode': Image.NEAREST},
@@ -54,7 +63,102 @@ resample_modes = [
 ]
 
 
+class ChainTrieNode:
+    """Node of a trie of enhancement chains. Chains that share a prefix of
+    algorithms share the nodes of that prefix, so it is only run once.
+    """
+
+    def __init__(self, algorithm_name=None, enhancement_algorithm=None):
+        self.algorithm_name = algorithm_name
+        self.enhancement_algorithm = enhancement_algorithm
+        self.children = {}
+        # Names of the chains that end at this node
+        self.chain_names = []
+
+    def get_node_count(self):
+        return 1 + sum(child.get_node_count() for child in self.children.values())
+
+
+def get_algorithm_name(enhancement_algorithm):
+    name = ENHANCEMENT_TYPE_NAMES[enhancement_algorithm.enhancement_type]
+    for param_name, param_value in sorted(
+            enhancement_algorithm.factor_determiner.get_params().items()):
+        # Leave out parameters left at their defaults
+        if param_value is None or param_value == 0:
+            continue
+        name += '_' + param_name.replace('_val', '') + '_' + str(param_value)
+    return name
+
+
+def expand_grid(grid):
+    """Get an EnhancementAlgorithmList for every chain in the grid."""
+    enhancement_algorithm_lists = []
+    for stage_algorithms in itertools.product(*grid):
+        enhancement_algorithms = [
+            enhancement_algorithm for enhancement_algorithm in stage_algorithms
+            if enhancement_algorithm is not None]
+        name = '-'.join(get_algorithm_name(enhancement_algorithm)
+                        for enhancement_algorithm in enhancement_algorithms)
+        enhancement_algorithm_lists.append(
+            EnhancementAlgorithmList(name or 'original', enhancement_algorithms))
+    return enhancement_algorithm_lists
+
+
+def build_chain_trie(enhancement_algorithm_lists):
+    root = ChainTrieNode()
+    for enhancement_algorithm_list in enhancement_algorithm_lists:
+        node = root
+        for enhancement_algorithm in enhancement_algorithm_list.enhancement_algorithms:
+            algorithm_name = get_algorithm_name(enhancement_algorithm)
+            if algorithm_name not in node.children:
+                node.children[algorithm_name] = ChainTrieNode(
+                    algorithm_name, enhancement_algorithm)
+            node = node.children[algorithm_name]
+        node.chain_names.append(enhancement_algorithm_list.name)
+    return root
+
+
+def get_quality_metrics(img, original_img):
+    luma_img = img.convert('L')
+    histogram = luma_img.histogram()
+    return {
+        'brightness': get_brightness(img),
+        'saturation': get_saturation(img),
+        'contrast': ImageStat.Stat(luma_img).stddev[0],
+        # Share of pixels crushed to black or blown to white
+        'clipped_pct': (histogram[0] + histogram[255]) / sum(histogram) * 100,
+        'psnr_db': utils.get_psnr(img, original_img)
+    }
+
+
+def evaluate_chain_trie(node, img, original_img, elapsed_s, results, enhancement_dir=None, base_image_name=None):
+    """Walk the trie depth first, enhancing each node's image from its
+    parent's, and record the metrics and cumulative time of every chain.
+
+    Returns the time spent enhancing in the subtree of node.
+    """
+    for chain_name in node.chain_names:
+        results[chain_name] = (get_quality_metrics(img, original_img), elapsed_s)
+        if enhancement_dir:
+            output_filename = base_image_name + '-' + chain_name + '.jpg'
+            img.save(os.path.join(enhancement_dir, output_filename),
+                     quality=settings.ImageProcessing.jpeg_quality)
+
+    subtree_s = 0
+    for child in node.children.values():
+        start_time = time.perf_counter()
+        child_img = child.enhancement_algorithm.enhance(img)
+        enhance_s = time.perf_counter() - start_time
+        subtree_s += enhance_s + evaluate_chain_trie(
+            child, child_img, original_img, elapsed_s + enhance_s, results,
+            enhancement_dir, base_image_name)
+    return subtree_s
+
+
 def test_resize_resample_modes(img, base_image_name):
+    resample_dir = os.path.join(settings.DirPaths.test_dest_images, 'resample')
+    os.makedirs(resample_dir, exist_ok=True)
+
     for resample_mode in resample_modes:
         mode = resample_mode['mode']
         mode_name = resample_mode['name']
@@ -63,39 +167,189 @@ def test_resize_resample_modes(img, base_image_name):
             img, OUTPUT_IMAGE_WIDTH, OUTPUT_IMAGE_HEIGHT, mode)
 
         output_filename = base_image_name + '-' + mode_name + '.jpg'
-        output_path = os.path.join(
-            settings.DirPaths.test_dest_images, 'resample', output_filename)
+        output_path = os.path.join(resample_dir, output_filename)
+
+        result_img.save(output_path, quality=settings.ImageProcessing.jpeg_quality, optimize=True)
+
+
+def test_enhancement_algorithms(filepath, chain_trie, save_images=False):
+    """Run every chain of chain_trie on one test image.
+
+    Returns (filepath, {chain_name: (metrics, seconds)}, seconds spent
+    walking the trie), or an error message in place of the results.
+    """
+    base_image_name = os.path.basename(filepath)
+    try:
+        img = Image.open(filepath)
+        img.draft('RGB', (OUTPUT_IMAGE_WIDTH, OUTPUT_IMAGE_HEIGHT))
+        resized_img = utils.resize_fill_image(
+            img.convert('RGB'), OUTPUT_IMAGE_WIDTH, OUTPUT_IMAGE_HEIGHT, Image.BILINEAR)
+    except Exception as e:
+        return filepath, type(e).__name__ + ': ' + str(e), 0
+
+    enhancement_dir = None
+    if save_images:
+        enhancement_dir = os.path.join(settings.DirPaths.test_dest_images, 'enhancement')
+        os.makedirs(enhancement_dir, exist_ok=True)
+
+        # Save original image
+        output_path = os.path.join(enhancement_dir, base_image_name + '-original.jpg')
+        resized_img.save(output_path, quality=settings.ImageProcessing.jpeg_quality)
+
+    results = {}
+    trie_s = evaluate_chain_trie(
+        chain_trie, resized_img, resized_img, 0, results, enhancement_dir, base_image_name)
+    return filepath, results, trie_s
 
-        result_img.save(output_path, quality=settings.ImageProcessing.jpeg_quality,optimize=true)
 
+def get_test_image_filepaths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from utils.iter_image_filepaths_in_tree(path)
+        else:
+            yield path
 
-def test_enhancement_algorithms(img, base_image_name):
-    enhancement_dir = os.path.join(
-        settings.DirPaths.test_dest_images, 'enhancement')
-    print(base_image_name)
 
-    # Save original image
-    output_path = os.path.join(enhancement_dir, base_image_name + '-original.jpg')
-    img.save(output_path, quality=settings.ImageProcessing.jpeg_quality)
+def get_metric_mean(chain_results, metric_name):
+    values = [metrics[metric_name] for _, metrics, _ in chain_results]
+    if metric_name == 'psnr_db':
+        # Unchanged images have an infinite PSNR, which would swamp the
+        # mean, so they are counted separately
+        finite_values = [value for value in values if value != float('inf')]
+        if not finite_values:
+            return float('inf')
+        return utils.mean(finite_values)
+    return utils.mean(values)
 
+
+def print_results_table(enhancement_algorithm_lists, results_by_chain):
+    name_width = max(len(enhancement_algorithm_list.name)
+                     for enhancement_algorithm_list in enhancement_algorithm_lists)
+    print(('%-' + str(name_width) + 's' + ' %11s' * 8) % (
+        ('chain',) + tuple(METRIC_NAMES) + ('identical', 'mean ms', 'total s')))
     for enhancement_algorithm_list in enhancement_algorithm_lists:
-        # Enhance and save each enhanced image
-        enhanced_img = enhancement_algorithm_list.enhance(img)
+        chain_results = results_by_chain[enhancement_algorithm_list.name]
+        if not chain_results:
+            continue
+        metric_means = [get_metric_mean(chain_results, metric_name)
+                        for metric_name in METRIC_NAMES]
+        identical_count = sum(1 for _, metrics, _ in chain_results
+                              if metrics['psnr_db'] == float('inf'))
+        total_s = sum(elapsed_s for _, _, elapsed_s in chain_results)
+        print(('%-' + str(name_width) + 's' + ' %11.2f' * 5 + ' %11d' + ' %11.2f' * 2) % (
+            (enhancement_algorithm_list.name,) + tuple(metric_means) +
+            (identical_count, total_s / len(chain_results) * 1000, total_s)))
 
-        output_filename = base_image_name + '-' + enhancement_algorithm_list.name + '.jpg'
-        output_path = os.path.join(enhancement_dir, output_filename)
 
-        enhanced_img.save(output_path, quality=settings.ImageProcessing.jpeg_quality)
+def save_results_csv(filepath, enhancement_algorithm_lists, results_by_chain):
+    with open(filepath, 'w', newline='') as results_file:
+        writer = csv.writer(results_file)
+        writer.writerow(['chain', 'image'] + METRIC_NAMES + ['seconds'])
+        for enhancement_algorithm_list in enhancement_algorithm_lists:
+            for image_filepath, metrics, elapsed_s in results_by_chain[
+                    enhancement_algorithm_list.name]:
+                writer.writerow(
+                    [enhancement_algorithm_list.name, image_filepath] +
+                    [metrics[metric_name] for metric_name in METRIC_NAMES] + [elapsed_s])
 
 
-# Program starts here
-for filepath in settings.FilePaths.test_images:
-    img = Image.open(filepath)
+def parse_number(value):
+    """Parse a parameter value, keeping whole numbers as ints so chain
+    names stay short.
+    """
+    number = float(value)
+    return int(number) if number.is_integer() else number
 
-    base_image_name = os.path.basename(filepath)
 
-    # test_resize_resample_modes(img, base_image_name)
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Grid search enhancement algorithm chains over test images.')
+    parser.add_argument(
+        'images', nargs='*',
+        help='test images or directories of them (default: FilePaths.test_images)')
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count() or 1,
+        help='number of processes used to evaluate images (default: all cores)')
+    parser.add_argument(
+        '--csv', metavar='RESULTS_PATH',
+        help='also write the metrics and time of every chain on every image to RESULTS_PATH')
+    parser.add_argument(
+        '--save-images', action='store_true',
+        help='save every enhanced image to the enhancement test output directory')
+    parser.add_argument(
+        '--resample', action='store_true',
+        help='also save each test image resized with every resample mode')
+    parser.add_argument(
+        '--saturation-min', type=parse_number, nargs='+', metavar='VALUE',
+        default=DEFAULT_SATURATION_MIN_VALS,
+        help='min_val values to try in the saturation stage (default: ' +
+             ' '.join(map(str, DEFAULT_SATURATION_MIN_VALS)) + ')')
+    parser.add_argument(
+        '--saturation-max', type=parse_number, nargs='+', metavar='VALUE',
+        default=DEFAULT_SATURATION_MAX_VALS,
+        help='max_val values to try in the saturation stage (default: ' +
+             ' '.join(map(str, DEFAULT_SATURATION_MAX_VALS)) + ')')
+    parser.add_argument(
+        '--brightness-min', type=parse_number, nargs='+', metavar='VALUE',
+        default=DEFAULT_BRIGHTNESS_MIN_VALS,
+        help='min_val values to try in the brightness stage (default: ' +
+             ' '.join(map(str, DEFAULT_BRIGHTNESS_MIN_VALS)) + ')')
+    parser.add_argument(
+        '--autocontrast-cutoff', type=parse_number, nargs='+', metavar='PERCENT',
+        default=DEFAULT_AUTOCONTRAST_CUTOFFS,
+        help='cutoff values to try in the autocontrast stage (default: ' +
+             ' '.join(map(str, DEFAULT_AUTOCONTRAST_CUTOFFS)) + ')')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    enhancement_algorithm_lists = expand_grid(get_enhancement_grid(
+        args.saturation_min, args.saturation_max, args.brightness_min,
+        args.autocontrast_cutoff))
+    chain_trie = build_chain_trie(enhancement_algorithm_lists)
+    chain_step_count = sum(len(enhancement_algorithm_list.enhancement_algorithms)
+                           for enhancement_algorithm_list in enhancement_algorithm_lists)
+    print(str(len(enhancement_algorithm_lists)) + ' chains of ' + str(chain_step_count) +
+          ' enhancement steps share ' + str(chain_trie.get_node_count() - 1) + ' trie nodes')
+
+    filepaths = list(get_test_image_filepaths(args.images or settings.FilePaths.test_images))
+
+    if args.resample:
+        for filepath in filepaths:
+            test_resize_resample_modes(Image.open(filepath), os.path.basename(filepath))
+
+    evaluate = functools.partial(
+        test_enhancement_algorithms, chain_trie=chain_trie, save_images=args.save_images)
+    results_by_chain = {
+        enhancement_algorithm_list.name: []
+        for enhancement_algorithm_list in enhancement_algorithm_lists}
+    trie_s = 0
+    start_time = time.perf_counter()
+    with Pool(args.workers) as pool:
+        for filepath, results, elapsed_s in pool.imap(evaluate, filepaths):
+            if isinstance(results, str):
+                print('Skipping ' + filepath + ': ' + results)
+                continue
+            trie_s += elapsed_s
+            for chain_name, (metrics, chain_elapsed_s) in results.items():
+                results_by_chain[chain_name].append((filepath, metrics, chain_elapsed_s))
+    wall_s = time.perf_counter() - start_time
+
+    print()
+    print_results_table(enhancement_algorithm_lists, results_by_chain)
+    print()
+    chains_s = sum(elapsed_s for enhancement_algorithm_list in enhancement_algorithm_lists
+                   for _, _, elapsed_s in results_by_chain[enhancement_algorithm_list.name])
+    print('Evaluated ' + str(len(filepaths)) + ' images in ' + str(round(wall_s, 1)) +
+          ' s on ' + str(args.workers) + ' workers. Enhancing took ' + str(round(trie_s, 1)) +
+          ' s through the trie, ' + str(round(chains_s, 1)) + ' s if every chain ran on its own')
+
+    if args.csv:
+        print('Saving results to ' + args.csv + '...')
+        save_results_csv(args.csv, enhancement_algorithm_lists, results_by_chain)
 
-    resized_img = utils.resize_fill_image(img, OUTPUT_IMAGE_WIDTH, OUTPUT_IMAGE_HEIGHT, Image.BILINEAR)
 
-    test_enhancement_algorithms(resized_img, base_image_name)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""Benchmark the image pipeline on a deterministic synthetic photo corpus.
+
+Usage:
+    python pipeline_benchmark.py [--save-baseline] [--baseline PATH]
+
+Generates a corpus of synthetic JPEGs in a park/season directory layout,
+renders every output instance of every image and reports images/sec for
+the whole pipeline and for each render stage. Results are compared against
+the baseline file, and any metric that is slower than the baseline by more
+than the threshold is flagged as a regression.
+
+With --check-engines, the NumPy enhancement engine is also compared with
+the PIL engine on several enhancement chains, and any chain that differs by
+more than the engine tolerance fails the run.
+"""
+from PIL import Image
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from ctg_builder.image_algorithm import FactorDeterminer, EnhancementType, EnhancementAlgorithm, EnhancementAlgorithmList
+from ctg_builder.manifest import BuildManifest
+from ctg_builder.models import ParkImage
+from ctg_builder.profiling import BuildProfiler
+from ctg_builder.rendering import RenderJob, render_park_image
+
+CORPUS_VERSION = 1
+DEFAULT_BASELINE_FILEPATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+PARK_NAMES = ['Alder Creek Park', 'Birch Hollow Park', 'Cedar Ridge Park']
+SEASON_NAMES = ['Spring', 'Summer', 'Fall']
+
+# (width, height) of the synthetic sources: landscape and portrait camera
+# frames, square crops and a stitched panorama
+SOURCE_SIZES = [
+    (3000, 2000),
+    (2000, 3000),
+    (2400, 1800),
+    (1800, 1800),
+    (4800, 1200)
+]
+
+
+def get_engine_check_lists():
+    """Get enhancement chains whose brightness and colour steps push pixels
+    past 0-255 in different orders, amplify earlier rounding by
+    desaturating and resaturating, or stretch it with autocontrast.
+    """
+    def brightness(**kwargs):
+        return EnhancementAlgorithm(EnhancementType.Brightness, FactorDeterminer(**kwargs))
+
+    def saturation(**kwargs):
+        return EnhancementAlgorithm(EnhancementType.Saturation, FactorDeterminer(**kwargs))
+
+    def autocontrast(**kwargs):
+        return EnhancementAlgorithm(EnhancementType.AutoContrast, FactorDeterminer(**kwargs))
+
+    return [
+        EnhancementAlgorithmList('Saturation-30-to-130_BrightFix', [
+            saturation(min_val=30, max_val=130), brightness(min_val=100)]),
+        EnhancementAlgorithmList('Bright-200_Saturation-150', [
+            brightness(target_val=200), saturation(target_val=150)]),
+        EnhancementAlgorithmList('Saturation-150_Bright-200', [
+            saturation(target_val=150), brightness(target_val=200)]),
+        EnhancementAlgorithmList('Bright-200_Saturation-150_Bright-160', [
+            brightness(target_val=200), saturation(target_val=150), brightness(target_val=160)]),
+        EnhancementAlgorithmList('Bright-200_AutoContrast-1_Saturation-150', [
+            brightness(target_val=200), autocontrast(cutoff=1), saturation(target_val=150)]),
+        EnhancementAlgorithmList('Saturation-30-to-130_BrightFix_AutoContrast', [
+            saturation(min_val=30, max_val=130), brightness(min_val=100), autocontrast()]),
+        EnhancementAlgorithmList('Saturation-30-to-130_BrightFix_AutoContrast-0.01', [
+            saturation(min_val=30, max_val=130), brightness(min_val=100), autocontrast(cutoff=0.01)]),
+        EnhancementAlgorithmList('Saturation-40_Bright-140_Saturation-120', [
+            saturation(max_val=40), brightness(min_val=140), saturation(min_val=120)]),
+        EnhancementAlgorithmList('Saturation-20_Bright-160_Saturation-150', [
+            saturation(max_val=20), brightness(min_val=160), saturation(min_val=150)]),
+        EnhancementAlgorithmList('Saturation-30_Bright-120_Saturation-130_AutoContrast', [
+            saturation(max_val=30), brightness(min_val=120), saturation(min_val=130), autocontrast()])
+    ]
+
+
+class BenchmarkOutputInstance:
+
+    def __init__(self, img_width, img_height, watermark_font_size, filename_add):
+        self.img_width = img_width
+        self.img_height = img_height
+        self.watermark_font_size = watermark_font_size
+        self.filename_add = filename_add
+        self.enhancement_algorithm_list = EnhancementAlgorithmList(
+            'Saturation-30-to-130_BrightFix', [
+                EnhancementAlgorithm(
+                    enhancement_type=EnhancementType.Saturation,
+                    factor_determiner=FactorDeterminer(min_val=30, max_val=130)),
+                EnhancementAlgorithm(
+                    enhancement_type=EnhancementType.Brightness,
+                    factor_determiner=FactorDeterminer(min_val=100))
+            ])
+
+
+class BenchmarkImageProcessing:
+    jpeg_quality = 85
+    output_instances = {
+        'large': BenchmarkOutputInstance(1280, 960, 24, '-large'),
+        'medium': BenchmarkOutputInstance(640, 480, 16, '-medium'),
+        'thumb': BenchmarkOutputInstance(320, 240, 10, '-thumb')
+    }
+
+    class Watermark:
+        text = 'Trail Guide'
+        rgb = (255, 255, 255)
+
+
+def generate_synthetic_image(rng, width, height):
+    """Build a photo-like image from a small random tile, so the JPEG has
+    smooth gradients as well as fine detail.
+    """
+    tile_width = rng.randint(6, 24)
+    tile_height = rng.randint(6, 24)
+    tile_bytes = bytes(rng.randrange(256) for _ in range(tile_width * tile_height * 3))
+    tile = Image.frombytes('RGB', (tile_width, tile_height), tile_bytes)
+    img = tile.resize((width, height), Image.BICUBIC)
+
+    detail_bytes = bytes(rng.randrange(256) for _ in range(64 * 48))
+    detail = Image.frombytes('L', (64, 48), detail_bytes).resize((width, height), Image.NEAREST)
+    return Image.blend(img, Image.merge('RGB', [detail] * 3), 0.15)
+
+
+def generate_corpus(corpus_dirpath, image_count, seed):
+    """Write image_count synthetic JPEGs to corpus_dirpath.
+
+    The corpus only depends on image_count and seed, so it is reused if a
+    matching one already exists.
+    """
+    spec = {'version': CORPUS_VERSION, 'image_count': image_count, 'seed': seed}
+    spec_filepath = os.path.join(corpus_dirpath, 'corpus.json')
+    if os.path.isfile(spec_filepath):
+        with open(spec_filepath) as spec_file:
+            if json.load(spec_file) == spec:
+                return
+        shutil.rmtree(corpus_dirpath)
+
+    rng = random.Random(seed)
+    src_dirpath = os.path.join(corpus_dirpath, 'src')
+
+    for i in range(image_count):
+        park_name = PARK_NAMES[i % len(PARK_NAMES)]
+        season_name = SEASON_NAMES[(i // len(PARK_NAMES)) % len(SEASON_NAMES)]
+        dirpath = os.path.join(src_dirpath, park_name, season_name)
+        os.makedirs(dirpath, exist_ok=True)
+
+        width, height = SOURCE_SIZES[i % len(SOURCE_SIZES)]
+        img = generate_synthetic_image(rng, width, height)
+
+        # Give every other image an EXIF capture date
+        exif = Image.Exif()
+        if i % 2 == 0:
+            exif[0x8769] = {36867: '2019:%02d:%02d 10:%02d:00' % (
+                i % 12 + 1, i % 28 + 1, i % 60)}
+
+        filepath = os.path.join(dirpath, 'IMG_%04d.jpg' % (i + 1))
+        img.save(filepath, 'JPEG', quality=92, exif=exif)
+
+    with open(spec_filepath, 'w') as spec_file:
+        json.dump(spec, spec_file)
+
+
+def run_benchmark(corpus_dirpath, img_settings, cascade_psnrs=None):
+    """Build models and render every output instance once.
+
+    Returns images/sec for the whole pipeline and for each render stage.
+    With cascade checking enabled, the PSNR of every cascaded instance
+    against the independent path is appended to cascade_psnrs.
+    """
+    src_dirpath = os.path.join(corpus_dirpath, 'src')
+    dest_dirpath = tempfile.mkdtemp(prefix='ctg-benchmark-')
+
+    try:
+        start_time = time.perf_counter()
+
+        src_filepaths = []
+        for dirpath, dirnames, filenames in os.walk(src_dirpath):
+            dirnames.sort()
+            src_filepaths.extend(
+                os.path.join(dirpath, filename) for filename in sorted(filenames))
+
+        park_image_models = [
+            ParkImage(src_filepath, src_dirpath, dest_dirpath, img_settings.output_instances)
+            for src_filepath in src_filepaths]
+
+        manifest = BuildManifest(os.path.join(dest_dirpath, 'manifest.json'))
+        profiler = BuildProfiler()
+        for park_image_model in park_image_models:
+            render_job = RenderJob(
+                park_image_model, park_image_model.dest_instances,
+                manifest.get_source_key(park_image_model.src_filepath))
+            result = render_park_image(render_job, img_settings)
+            if result.error:
+                raise RuntimeError(result.src_filepath + ': ' + result.error)
+            profiler.add(result.src_filepath, result.profile)
+            if cascade_psnrs is not None:
+                cascade_psnrs.extend(result.cascade_psnrs)
+
+        elapsed_time = time.perf_counter() - start_time
+    finally:
+        shutil.rmtree(dest_dirpath)
+
+    image_count = len(park_image_models)
+    results = {'pipeline': image_count / elapsed_time}
+    for stage_summary in profiler.get_stage_summaries():
+        if stage_summary['instance'] is None:
+            results[stage_summary['stage']] = image_count / stage_summary['total_s']
+    return results
+
+
+def check_enhancement_engines(corpus_dirpath):
+    """Enhance every corpus image at the large instance size with both
+    engines for each chain of get_engine_check_lists.
+
+    Returns the largest and mean difference in levels of each chain.
+    """
+    # Imported here so the benchmark itself does not require numpy
+    from ctg_builder import image_algorithm_numpy
+
+    src_dirpath = os.path.join(corpus_dirpath, 'src')
+    img_width = BenchmarkImageProcessing.output_instances['large'].img_width
+    img_height = BenchmarkImageProcessing.output_instances['large'].img_height
+
+    differences = {}
+    for dirpath, dirnames, filenames in os.walk(src_dirpath):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            with Image.open(os.path.join(dirpath, filename)) as src_img:
+                img = src_img.convert('RGB').resize((img_width, img_height), Image.BICUBIC)
+
+            for enhancement_algorithm_list in get_engine_check_lists():
+                max_difference, mean_difference = \
+                    image_algorithm_numpy.get_difference_from_pil(img, enhancement_algorithm_list)
+                name = enhancement_algorithm_list.name
+                previous_max, previous_means = differences.get(name, (0, []))
+                differences[name] = (max(previous_max, max_difference), previous_means + [mean_difference])
+
+    return {name: (max_difference, sum(means) / len(means))
+            for name, (max_difference, means) in differences.items()}
+
+
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for name, images_per_sec in results.items():
+        baseline_images_per_sec = baseline.get(name)
+        if not baseline_images_per_sec:
+            continue
+        if images_per_sec < baseline_images_per_sec * (1 - threshold):
+            regressions.append(name)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the image pipeline on a synthetic corpus.')
+    parser.add_argument(
+        '--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'ctg-benchmark-corpus'),
+        help='where the synthetic corpus is generated and cached')
+    parser.add_argument('--images', type=int, default=30, help='corpus size (default: 30)')
+    parser.add_argument('--seed', type=int, default=1, help='corpus seed (default: 1)')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='number of runs; the fastest result of each metric is kept (default: 3)')
+    parser.add_argument(
+        '--cascade', action='store_true',
+        help='render smaller instances from larger ones and report their '
+             'difference from independently rendered instances')
+    parser.add_argument(
+        '--baseline', default=DEFAULT_BASELINE_FILEPATH,
+        help='baseline results file (default: benchmark_baseline.json)')
+    parser.add_argument(
+        '--save-baseline', action='store_true',
+        help='store the results as the new baseline')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='slowdown relative to the baseline that counts as a regression (default: 0.1)')
+    parser.add_argument(
+        '--check-engines', action='store_true',
+        help='also check that the NumPy enhancement engine matches the PIL '
+             'engine within its tolerance on several enhancement chains')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    print('Generating corpus in ' + args.corpus_dir + '...')
+    generate_corpus(args.corpus_dir, args.images, args.seed)
+
+    if args.cascade:
+        BenchmarkImageProcessing.cascade_rendering = True
+
+    results = {}
+    for i in range(args.repeat):
+        print('Run ' + str(i + 1) + ' of ' + str(args.repeat) + '...')
+        for name, images_per_sec in run_benchmark(
+                args.corpus_dir, BenchmarkImageProcessing).items():
+            results[name] = max(results.get(name, 0), images_per_sec)
+
+    if args.cascade:
+        # Measured in a separate run so the check does not skew the timings
+        cascade_psnrs = []
+        BenchmarkImageProcessing.cascade_check = True
+        run_benchmark(args.corpus_dir, BenchmarkImageProcessing, cascade_psnrs)
+        BenchmarkImageProcessing.cascade_check = False
+
+        print()
+        print('%-12s %12s %12s' % ('instance', 'min PSNR dB', 'mean PSNR dB'))
+        for img_name in BenchmarkImageProcessing.output_instances:
+            psnrs = [psnr for name, psnr in cascade_psnrs
+                     if name == img_name and psnr != float('inf')]
+            if psnrs:
+                print('%-12s %12.1f %12.1f' % (img_name, min(psnrs), sum(psnrs) / len(psnrs)))
+            else:
+                print('%-12s %12s %12s' % (img_name, 'identical', 'identical'))
+
+    engine_failures = []
+    if args.check_engines:
+        from ctg_builder.image_algorithm_numpy import PIL_ENGINE_TOLERANCE
+
+        print()
+        print('%-54s %8s %8s' % ('enhancement chain', 'max', 'mean'))
+        for name, (max_difference, mean_difference) in sorted(
+                check_enhancement_engines(args.corpus_dir).items()):
+            flag = ''
+            if max_difference > PIL_ENGINE_TOLERANCE:
+                engine_failures.append(name)
+                flag = '  OVER TOLERANCE'
+            print('%-54s %8d %8.2f%s' % (name, max_difference, mean_difference, flag))
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    regressions = find_regressions(results, baseline, args.threshold)
+
+    print()
+    print('%-12s %12s %12s' % ('metric', 'images/sec', 'baseline'))
+    for name, images_per_sec in sorted(results.items()):
+        baseline_text = '%.2f' % baseline[name] if name in baseline else '-'
+        flag = '  REGRESSION' if name in regressions else ''
+        print('%-12s %12.2f %12s%s' % (name, images_per_sec, baseline_text, flag))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=1, sort_keys=True)
+        print('Saved baseline to ' + args.baseline)
+
+    if regressions or engine_failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()